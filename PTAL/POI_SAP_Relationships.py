@@ -1,175 +1,145 @@
-from qgis.core import QgsProject, QgsField, QgsVectorLayer, QgsFeature, QgsTask, QgsApplication, QgsGeometry
+from qgis.core import Qgis, QgsProject, QgsField, QgsVectorLayer, QgsTask, QgsApplication, QgsMessageLog, QgsWkbTypes
 from PyQt5.QtCore import QVariant
-import processing
-import gc
+import multiprocessing
+import os
+import sys
+
+# Make the helper modules next to this script importable from the QGIS Python console
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+if SCRIPT_DIR not in sys.path:
+    sys.path.append(SCRIPT_DIR)
+
+# Worker processes have to start the bundled Python interpreter instead of QGIS itself
+if os.name == 'nt':
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+
+from checkpoint import Checkpoint
+from distance_cache import DistanceCache
+from qgis_layers import LayerSink, road_graph_for_layer
+from relationship_writer import COMPACT_SAP_FIELDS, RelationshipBuffer, relationship_field_name
+from relationships import POI_CENTRIC, SAP_CENTRIC, relationships_by_tile, relationships_from_pois, relationships_from_saps, relationships_in_parallel
 
 class ProcessPOITask(QgsTask):
-    def __init__(self, poi_layer, road_network, sap_bus_layer, sap_trein_layer, output_layer, description="Processing POIs"):
+    def __init__(self, poi_layer, road_network, sap_bus_layer, sap_trein_layer, output_layer, mode=POI_CENTRIC, workers=1, distance_cache_path=None, checkpoint_path=None, batch_size=50_000, description="Processing POIs"):
         super().__init__(description)
         self.poi_layer = poi_layer
         self.road_network = road_network
         self.sap_bus_layer = sap_bus_layer
         self.sap_trein_layer = sap_trein_layer
         self.output_layer = output_layer
-        self.output_provider = output_layer.dataProvider()
         self.total_pois = len([f for f in poi_layer.getFeatures()])
         self.progress = 0
+        self.mode = mode
+        self.workers = workers
+        self.distance_cache_path = distance_cache_path
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.exception = None
+        if mode == SAP_CENTRIC and workers == 1 and not checkpoint_path:
+            self.total_steps = sap_bus_layer.featureCount() + sap_trein_layer.featureCount()
+        else:
+            self.total_steps = 2 * self.total_pois
 
     def update_progress(self, step=1):
         self.progress += step
-        self.setProgress((self.progress / (2 * self.total_pois)) * 100)
+        self.setProgress((self.progress / self.total_steps) * 100)
 
     def run(self):
         try:
-            # Enable editing mode
-            self.output_layer.startEditing()
-
-            def process_layer(layer_name, sap_layer, max_distance):
+            # Reuse the road graph of this network, every search runs on it
+            road_graph = road_graph_for_layer(self.road_network)
+
+            # Keep the finished POIs and their rows on disk when a checkpoint file is given, a rerun resumes from it
+            checkpoint = Checkpoint(self.checkpoint_path, road_graph.network_hash) if self.checkpoint_path else None
+
+            def until_canceled(rows):
+                # Stop taking rows once the task is cancelled
+                for row in rows:
+                    if self.isCanceled():
+                        return
+                    yield row
+
+            def valid_poi_geometries():
+                # Map every POI with a valid geometry to that geometry
+                poi_geometries = {}
                 for poi_feature in self.poi_layer.getFeatures():
-                    # Get the geometry and ID of the POI
                     geometry = poi_feature.geometry()
-                    poi_id = poi_feature['fid']
-
-                    if not geometry.isGeosValid():
-                        continue
-
-                    # Create a buffer around the POI
-                    buffer_geometry = geometry.buffer(max_distance, 5)
-
-                    # Create a temporary buffer layer
-                    buffer_layer = QgsVectorLayer(f"Polygon?crs={self.poi_layer.crs().authid()}", f"{layer_name}_Buffer_{poi_id}", "memory")
-                    buffer_provider = buffer_layer.dataProvider()
-
-                    buffer_feature = QgsFeature()
-                    buffer_feature.setGeometry(buffer_geometry)
-                    buffer_provider.addFeature(buffer_feature)
-                    buffer_layer.updateExtents()
-
-                    # Clip the SAP layer using the buffer
-                    sap_clip_parameters = {
-                        'INPUT': sap_layer.source(),
-                        'OVERLAY': buffer_layer,
-                        'OUTPUT': 'TEMPORARY_OUTPUT'
-                    }
-                    sap_clip_result = processing.run("native:clip", sap_clip_parameters)
-                    clipped_sap_layer = sap_clip_result['OUTPUT']
-
-                    # Clip the road network using the buffer layer
-                    clip_parameters = {
-                        'INPUT': self.road_network.source(),
-                        'OVERLAY': buffer_layer,
-                        'OUTPUT': 'TEMPORARY_OUTPUT'
-                    }
-                    clip_result = processing.run("native:clip", clip_parameters)
-                    clipped_road_network = clip_result['OUTPUT']
-
-                    # Prepare the Service Area tool parameters
-                    service_area_parameters = {
-                        'INPUT': clipped_road_network,
-                        'STRATEGY': 0,
-                        'DIRECTION_FIELD': '',
-                        'VALUE_FORWARD': '',
-                        'VALUE_BACKWARD': '',
-                        'VALUE_BOTH': '',
-                        'DEFAULT_DIRECTION': 2,
-                        'SPEED_FIELD': '',
-                        'DEFAULT_SPEED': 50,
-                        'TOLERANCE': 0,
-                        'START_POINT': f"{geometry.asPoint().x()},{geometry.asPoint().y()} [EPSG:{self.poi_layer.crs().postgisSrid()}]",
-                        'TRAVEL_COST2': max_distance,
-                        'INCLUDE_BOUNDS': False,
-                        'OUTPUT_LINES': 'TEMPORARY_OUTPUT'
-                    }
-
-                    service_area_result = processing.run("native:serviceareafrompoint", service_area_parameters)
-                    service_area_layer = service_area_result['OUTPUT_LINES']
-
-                    # Join SAPs to the network using `native:joinbynearest`
-                    join_parameters = {
-                        'INPUT': clipped_sap_layer,
-                        'INPUT_2': service_area_layer,
-                        'FIELDS_TO_COPY': [],
-                        'DISCARD_NONMATCHING': True,
-                        'PREFIX': '',
-                        'NEIGHBORS': 1,
-                        'MAX_DISTANCE': 1,
-                        'OUTPUT': 'TEMPORARY_OUTPUT',
-                    }
-
-                    join_result = processing.run("native:joinbynearest", join_parameters)
-                    joined_layer = join_result['OUTPUT']
-
-                    # Track already calculated distances to optimize performance
-                    calculated_distances = {}
-
-                    # Create separate rows for each SAP
-                    for sap_feature in joined_layer.getFeatures():
-                        sap_id = sap_feature['fid']
-                        sap_attributes = sap_feature.attributes()
-                        sap_geometry = sap_feature.geometry()
-
-                        # Check if the distance to this SAP geometry has already been calculated
-                        sap_geometry_wkt = sap_geometry.asWkt()
-                        if sap_geometry_wkt in calculated_distances:
-                            distance = calculated_distances[sap_geometry_wkt]
-                        else:
-                            # Calculate distance from POI to SAP along the network
-                            distance_parameters = {
-                                'INPUT': clipped_road_network,
-                                'DEFAULT_DIRECTION': 2,
-                                'STRATEGY': 0,
-                                'START_POINT': geometry.asPoint(),
-                                'END_POINT': sap_geometry.asPoint(),
-                                'OUTPUT': 'TEMPORARY_OUTPUT'
-                            }
-
-                            try:
-                                distance_result = processing.run("native:shortestpathpointtopoint", distance_parameters)
-                                distance_layer = distance_result['OUTPUT']
-                                distance_feature = next(distance_layer.getFeatures(), None)
-                                distance = distance_feature['cost'] if distance_feature and 'cost' in distance_feature.fields().names() else -1
-                            except Exception:
-                                distance = -1
-
-                            # Store the calculated distance
-                            calculated_distances[sap_geometry_wkt] = distance
-
-                        # Skip SAPs beyond the maximum distance
-                        if distance > max_distance:
-                            continue
-
-                        # Create a new feature with the POI geometry and SAP attributes
-                        new_feature = QgsFeature(self.output_layer.fields())
-                        new_feature.setGeometry(geometry)
-                        new_feature.setAttributes([poi_id] + [distance] + sap_attributes)
-                        self.output_provider.addFeature(new_feature)
-
-                    # Commit changes to the output layer after processing each POI
-                    self.output_layer.commitChanges()
-                    self.output_layer.startEditing()
-
-                    # Explicitly free memory
-                    buffer_layer = None
-                    clipped_sap_layer = None
-                    clipped_road_network = None
-                    service_area_layer = None
-                    joined_layer = None
-                    gc.collect()
-
-                    # Update progress
-                    self.update_progress()
-
-            # Process each layer
-            process_layer("sap_bus", self.sap_bus_layer, 400)
-            process_layer("sap_trein", self.sap_trein_layer, 3000)
-
-            return True
-        except Exception:
+                    if geometry.isGeosValid():
+                        poi_geometries[poi_feature['fid']] = geometry
+                return poi_geometries
+
+            def process_layer(sap_layer, max_distance):
+                # Collect the SAP points and attributes once, lookups go through a spatial index
+                saps = []
+                sap_attributes = {}
+                # The SAP field of every output field, the SAP fid is stored as sap_fid
+                sap_field_names = {relationship_field_name(name): name for name in sap_layer.fields().names()}
+                output_field_names = self.output_layer.fields().names()[2:]
+                for sap_feature in sap_layer.getFeatures():
+                    sap_point = sap_feature.geometry().asPoint()
+                    saps.append((sap_feature.id(), sap_point.x(), sap_point.y()))
+                    # Match SAP attributes to the output fields by name, a compact output layer has fewer fields
+                    sap_attributes[sap_feature.id()] = [sap_feature[sap_field_names[name]] if name in sap_field_names else None for name in output_field_names]
+
+                pois = [(poi_id, geometry.asPoint().x(), geometry.asPoint().y()) for poi_id, geometry in poi_geometries.items()]
+                output_buffer = RelationshipBuffer(output_sink, sap_attributes, self.batch_size)
+                if checkpoint:
+                    # The rows of POIs finished by an earlier run come from the checkpoint, the other POIs are
+                    # searched tile by tile and every finished tile is stored before its rows are added
+                    step = f"{sap_layer.name()}:{max_distance}"
+                    done = checkpoint.done(step)
+                    output_buffer.extend(checkpoint.rows(step))
+                    self.update_progress(len(done))
+                    tiles = relationships_by_tile(road_graph, [poi for poi in pois if poi[0] not in done], saps, max_distance, self.mode, self.workers, cache_path=self.distance_cache_path)
+                    for tile_pois, rows in tiles:
+                        checkpoint.add(step, [poi_id for poi_id, _, _ in tile_pois], rows)
+                        output_buffer.extend(rows)
+                        self.update_progress(len(tile_pois))
+                        if self.isCanceled():
+                            break
+                    tiles.close()
+                    output_buffer.flush()
+                    return not self.isCanceled()
+
+                distance_cache = None
+                if self.workers > 1:
+                    relationships = relationships_in_parallel(road_graph, pois, saps, max_distance, self.mode, self.workers, progress=self.update_progress, cache_path=self.distance_cache_path)
+                elif self.mode == SAP_CENTRIC:
+                    relationships = relationships_from_saps(road_graph, pois, saps, max_distance, self.update_progress)
+                else:
+                    # Reuse distances from earlier runs on the same network when a cache file is given;
+                    # the parallel and checkpoint paths open their own connections from distance_cache_path
+                    distance_cache = DistanceCache(self.distance_cache_path, road_graph.network_hash) if self.distance_cache_path else None
+                    relationships = relationships_from_pois(road_graph, pois, saps, max_distance, self.update_progress, distance_cache)
+
+                output_buffer.extend(until_canceled(relationships))
+                output_buffer.flush()
+                if distance_cache:
+                    distance_cache.close()
+                return not self.isCanceled()
+
+            poi_geometries = valid_poi_geometries()
+
+            # Rows are added to the output layer in batches, without an edit session to commit;
+            # an output layer without geometry gets compact rows with attributes only
+            output_sink = LayerSink(self.output_layer, None if self.output_layer.geometryType() == QgsWkbTypes.NullGeometry else poi_geometries)
+
+            # Process each layer, a cancelled task stops after the tile or row it is working on
+            completed = process_layer(self.sap_bus_layer, 400) and process_layer(self.sap_trein_layer, 3000)
+
+            if checkpoint:
+                checkpoint.close()
+
+            return completed
+        except Exception as exception:
+            self.exception = exception
             return False
 
     def finished(self, result):
         if result:
             QgsProject.instance().addMapLayer(self.output_layer)
+        elif self.exception is not None:
+            QgsMessageLog.logMessage(f"Processing POIs failed: {self.exception!r}", "PTAL", Qgis.Critical)
 
 # Main script
 poi_layer = QgsProject.instance().mapLayersByName('POI')[0]
@@ -177,17 +147,24 @@ road_network = QgsProject.instance().mapLayersByName('hartlijn_fiets_voet')[0]
 sap_bus_layer = QgsProject.instance().mapLayersByName('SAP_bus')[0]
 sap_trein_layer = QgsProject.instance().mapLayersByName('SAP_trein')[0]
 
+# Set to True for compact rows: no POI geometry and only the SAP fields PTAL_analysis and PTAL_score need
+compact_output = False
+
 # Create a new output layer for the results
-output_layer = QgsVectorLayer(f"Point?crs={poi_layer.crs().authid()}", "POI_SAP_Relationships", "memory")
+output_layer = QgsVectorLayer("None" if compact_output else f"Point?crs={poi_layer.crs().authid()}", "POI_SAP_Relationships", "memory")
 output_provider = output_layer.dataProvider()
 
 # Add fields from the POI and SAP layers
 poi_fields = [QgsField("POI_ID", QVariant.Int)]
-sap_fields = [QgsField(field.name(), field.type()) for field in sap_bus_layer.fields()]
+sap_fields = [QgsField(relationship_field_name(field.name()), field.type()) for field in sap_bus_layer.fields() if not compact_output or field.name() in COMPACT_SAP_FIELDS]
 distance_field = [QgsField("Distance", QVariant.Double)]
 output_provider.addAttributes(poi_fields + distance_field + sap_fields)
 output_layer.updateFields()
 
-# Create and schedule the task
+# Create and schedule the task (use mode=SAP_CENTRIC to search from the SAPs, faster for dense POI sets,
+# set workers to the number of cores to process spatial tiles of POIs in parallel
+# set distance_cache_path to a .sqlite file to reuse network distances between runs,
+# checkpoint_path to a .sqlite file to keep finished POIs on disk and resume from them after a crash or cancel
+# and batch_size to the number of rows added to the output layer at once)
 task = ProcessPOITask(poi_layer, road_network, sap_bus_layer, sap_trein_layer, output_layer)
 QgsApplication.taskManager().addTask(task)
@@ -1,190 +1,165 @@
-from qgis.core import QgsProject, QgsField, QgsVectorLayer, QgsFeature, QgsTask, QgsApplication, QgsGeometry
+from qgis.core import Qgis, QgsProject, QgsField, QgsVectorLayer, QgsTask, QgsApplication, QgsMessageLog
 from PyQt5.QtCore import QVariant
-import processing
-import gc
+import multiprocessing
+import os
+import sys
+
+# Make the helper modules next to this script importable from the QGIS Python console
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+if SCRIPT_DIR not in sys.path:
+    sys.path.append(SCRIPT_DIR)
+
+# Worker processes have to start the bundled Python interpreter instead of QGIS itself
+if os.name == 'nt':
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+
+from qgis_layers import LayerSink, road_graph_for_layer
+from relationship_writer import RelationshipBuffer, relationship_field_name
+from relationships import POI_CENTRIC, SAP_CENTRIC
+from scenarios import ScenarioRunner
 
 class ProcessPOITask(QgsTask):
-    def __init__(self, poi_layer, road_network, lelylijn_layer, output_layer, description="Processing POIs"):
+    def __init__(self, poi_layer, road_network, lelylijn_layers, output_layers, baseline_layer=None, mode=POI_CENTRIC, workers=1, distance_cache_path=None, batch_size=50_000, description="Processing POIs"):
         super().__init__(description)
         self.poi_layer = poi_layer
         self.road_network = road_network
-        self.lelylijn_layer = lelylijn_layer
-        self.output_layer = output_layer
-        self.output_provider = output_layer.dataProvider()
+        self.lelylijn_layers = lelylijn_layers
+        self.output_layers = output_layers
+        self.baseline_layer = baseline_layer
         self.total_pois = len([f for f in poi_layer.getFeatures()])
+        self.scenario = 0
         self.progress = 0
+        self.total_steps = 1
+        self.mode = mode
+        self.workers = workers
+        self.distance_cache_path = distance_cache_path
+        self.batch_size = batch_size
+        self.exception = None
 
     def update_progress(self, step=1):
+        # Every scenario gets an equal share of the progress bar
         self.progress += step
-        self.setProgress((self.progress / self.total_pois) * 100)
+        self.setProgress(((self.scenario + self.progress / self.total_steps) / len(self.lelylijn_layers)) * 100)
 
     def run(self):
         try:
-            # Enable editing mode
-            self.output_layer.startEditing()
-
-            def process_layer(layer_name, sap_layer, max_distance):
+            # Reuse the road graph of this network, every search runs on it
+            road_graph = road_graph_for_layer(self.road_network)
+
+            def until_canceled(rows):
+                # Stop taking rows once the task is cancelled
+                for row in rows:
+                    if self.isCanceled():
+                        return
+                    yield row
+
+            def valid_poi_geometries():
+                # Map every POI with a valid geometry to that geometry
+                poi_geometries = {}
                 for poi_feature in self.poi_layer.getFeatures():
-                    # Get the geometry and ID of the POI
                     geometry = poi_feature.geometry()
-                    poi_id = poi_feature['fid']
-
-                    if not geometry.isGeosValid():
-                        continue
-
-                    # Create a buffer around the POI
-                    buffer_geometry = geometry.buffer(max_distance, 5)
-
-                    # Create a temporary buffer layer
-                    buffer_layer = QgsVectorLayer(f"Polygon?crs={self.poi_layer.crs().authid()}", f"{layer_name}_Buffer_{poi_id}", "memory")
-                    buffer_provider = buffer_layer.dataProvider()
-
-                    buffer_feature = QgsFeature()
-                    buffer_feature.setGeometry(buffer_geometry)
-                    buffer_provider.addFeature(buffer_feature)
-                    buffer_layer.updateExtents()
-
-                    # Clip the SAP layer using the buffer
-                    sap_clip_parameters = {
-                        'INPUT': sap_layer.source(),
-                        'OVERLAY': buffer_layer,
-                        'OUTPUT': 'TEMPORARY_OUTPUT'
-                    }
-                    sap_clip_result = processing.run("native:clip", sap_clip_parameters)
-                    clipped_sap_layer = sap_clip_result['OUTPUT']
-
-                    # Clip the road network using the buffer layer
-                    clip_parameters = {
-                        'INPUT': self.road_network.source(),
-                        'OVERLAY': buffer_layer,
-                        'OUTPUT': 'TEMPORARY_OUTPUT'
-                    }
-                    clip_result = processing.run("native:clip", clip_parameters)
-                    clipped_road_network = clip_result['OUTPUT']
-
-                    # Prepare the Service Area tool parameters
-                    service_area_parameters = {
-                        'INPUT': clipped_road_network,
-                        'STRATEGY': 0,
-                        'DIRECTION_FIELD': '',
-                        'VALUE_FORWARD': '',
-                        'VALUE_BACKWARD': '',
-                        'VALUE_BOTH': '',
-                        'DEFAULT_DIRECTION': 2,
-                        'SPEED_FIELD': '',
-                        'DEFAULT_SPEED': 50,
-                        'TOLERANCE': 0,
-                        'START_POINT': f"{geometry.asPoint().x()},{geometry.asPoint().y()} [EPSG:{self.poi_layer.crs().postgisSrid()}]",
-                        'TRAVEL_COST2': max_distance,
-                        'INCLUDE_BOUNDS': False,
-                        'OUTPUT_LINES': 'TEMPORARY_OUTPUT'
-                    }
-
-                    service_area_result = processing.run("native:serviceareafrompoint", service_area_parameters)
-                    service_area_layer = service_area_result['OUTPUT_LINES']
-
-                    # Join SAPs to the network using `native:joinbynearest`
-                    join_parameters = {
-                        'INPUT': clipped_sap_layer,
-                        'INPUT_2': service_area_layer,
-                        'FIELDS_TO_COPY': [],
-                        'DISCARD_NONMATCHING': True,
-                        'PREFIX': '',
-                        'NEIGHBORS': 1,
-                        'MAX_DISTANCE': 1,
-                        'OUTPUT': 'TEMPORARY_OUTPUT',
-                    }
-
-                    join_result = processing.run("native:joinbynearest", join_parameters)
-                    joined_layer = join_result['OUTPUT']
-
-                    # Track already calculated distances to optimize performance
-                    calculated_distances = {}
-
-                    # Create separate rows for each SAP
-                    for sap_feature in joined_layer.getFeatures():
-                        sap_id = sap_feature['fid']
-                        sap_attributes = sap_feature.attributes()
-                        sap_geometry = sap_feature.geometry()
-
-                        # Check if the distance to this SAP geometry has already been calculated
-                        sap_geometry_wkt = sap_geometry.asWkt()
-                        if sap_geometry_wkt in calculated_distances:
-                            distance = calculated_distances[sap_geometry_wkt]
-                        else:
-                            # Calculate distance from POI to SAP along the network
-                            distance_parameters = {
-                                'INPUT': clipped_road_network,
-                                'DEFAULT_DIRECTION': 2,
-                                'STRATEGY': 0,
-                                'START_POINT': geometry.asPoint(),
-                                'END_POINT': sap_geometry.asPoint(),
-                                'OUTPUT': 'TEMPORARY_OUTPUT'
-                            }
-
-                            try:
-                                distance_result = processing.run("native:shortestpathpointtopoint", distance_parameters)
-                                distance_layer = distance_result['OUTPUT']
-                                distance_feature = next(distance_layer.getFeatures(), None)
-                                distance = distance_feature['cost'] if distance_feature and 'cost' in distance_feature.fields().names() else -1
-                            except Exception:
-                                distance = -1
-
-                            # Store the calculated distance
-                            calculated_distances[sap_geometry_wkt] = distance
-
-                        # Skip SAPs beyond the maximum distance
-                        if distance > max_distance:
-                            continue
-
-                        # Create a new feature with the POI geometry and SAP attributes
-                        new_feature = QgsFeature(self.output_layer.fields())
-                        new_feature.setGeometry(geometry)
-                        new_feature.setAttributes([poi_id] + [distance] + sap_attributes)
-                        self.output_provider.addFeature(new_feature)
-
-                    # Commit changes to the output layer after processing each POI
-                    self.output_layer.commitChanges()
-                    self.output_layer.startEditing()
-
-                    # Explicitly free memory
-                    buffer_layer = None
-                    clipped_sap_layer = None
-                    clipped_road_network = None
-                    service_area_layer = None
-                    joined_layer = None
-                    gc.collect()
-
-                    # Update progress
-                    self.update_progress()
-
-            # Process Lelylijn stops
-            process_layer("lelylijn", self.lelylijn_layer, 3000)
-
-            return True
-        except Exception:
+                    if geometry.isGeosValid():
+                        poi_geometries[poi_feature['fid']] = geometry
+                return poi_geometries
+
+            def process_layer(sap_layer, output_layer, max_distance):
+                # Collect the SAP points and attributes once, lookups go through a spatial index
+                saps = []
+                sap_attributes = {}
+                # The SAP field of every output field, the SAP fid is stored as sap_fid;
+                # a baseline from before that still calls it fid is matched as well
+                sap_field_names = {name: name for name in sap_layer.fields().names()}
+                sap_field_names.update({relationship_field_name(name): name for name in sap_layer.fields().names()})
+                output_field_names = output_layer.fields().names()[2:]
+                for sap_feature in sap_layer.getFeatures():
+                    sap_point = sap_feature.geometry().asPoint()
+                    saps.append((sap_feature.id(), sap_point.x(), sap_point.y()))
+                    # Match SAP attributes to the output fields by name, the baseline fields can differ
+                    sap_attributes[sap_feature.id()] = [sap_feature[sap_field_names[name]] if name in sap_field_names else None for name in output_field_names]
+
+                # In delta mode only POIs near the new stops can change, the rest keeps its baseline rows
+                if self.baseline_layer is not None:
+                    pois = scenario_runner.affected_pois(saps, max_distance)
+                else:
+                    pois = scenario_runner.pois
+                self.progress = 0
+                self.total_steps = max(len(saps) if self.mode == SAP_CENTRIC and self.workers == 1 else len(pois), 1)
+
+                # Rows are added to the output layer in batches, without an edit session to commit
+                output_buffer = RelationshipBuffer(LayerSink(output_layer, poi_geometries), sap_attributes, self.batch_size)
+                if pois:
+                    output_buffer.extend(until_canceled(scenario_runner.relationships(saps, max_distance, self.mode, self.workers, self.update_progress, pois=pois)))
+                output_buffer.flush()
+                return not self.isCanceled()
+
+            # Snap the POIs and build their spatial index once, all scenarios share them
+            poi_geometries = valid_poi_geometries()
+            scenario_runner = ScenarioRunner(road_graph, [(poi_id, geometry.asPoint().x(), geometry.asPoint().y()) for poi_id, geometry in poi_geometries.items()], self.distance_cache_path)
+            baseline_features = list(self.baseline_layer.getFeatures()) if self.baseline_layer is not None else []
+
+            # Process the Lelylijn stops of every scenario, a cancelled task stops after the row it is working on
+            completed = True
+            for self.scenario, (lelylijn_layer, output_layer) in enumerate(zip(self.lelylijn_layers, self.output_layers)):
+                # Start from the complete baseline relationships in delta mode
+                if baseline_features:
+                    output_layer.dataProvider().addFeatures(baseline_features)
+                completed = process_layer(lelylijn_layer, output_layer, 3000)
+                if not completed:
+                    break
+            scenario_runner.close()
+
+            return completed
+        except Exception as exception:
+            self.exception = exception
             return False
 
     def finished(self, result):
         if result:
-            QgsProject.instance().addMapLayer(self.output_layer)
+            for output_layer in self.output_layers:
+                QgsProject.instance().addMapLayer(output_layer)
+        elif self.exception is not None:
+            QgsMessageLog.logMessage(f"Processing scenarios failed: {self.exception!r}", "PTAL", Qgis.Critical)
 
 # Main script
 poi_layer = QgsProject.instance().mapLayersByName('POI')[0]
 road_network = QgsProject.instance().mapLayersByName('hartlijn_fiets_voet')[0]
-lelylijn_layer = QgsProject.instance().mapLayersByName('Lelylijn_sc1')[0] # Change this to the correct layer name
-
-# Create a new output layer for the results
-output_layer = QgsVectorLayer(f"Point?crs={poi_layer.crs().authid()}", "POI_SAP_Relationships", "memory")
-output_provider = output_layer.dataProvider()
-
-# Add fields from the POI and SAP layers
-poi_fields = [QgsField("POI_ID", QVariant.Int)]
-sap_fields = [QgsField(field.name(), field.type()) for field in lelylijn_layer.fields()]
-distance_field = [QgsField("Distance", QVariant.Double)]
-output_provider.addAttributes(poi_fields + distance_field + sap_fields)
-output_layer.updateFields()
 
-# Create and schedule the task
-task = ProcessPOITask(poi_layer, road_network, lelylijn_layer, output_layer)
+# Scenario layers to run in one go, they share the road graph, POI snapping and spatial indexes
+scenario_names = ['Lelylijn_sc1'] # Change this to the correct layer names, e.g. ['Lelylijn_sc1', ..., 'Lelylijn_sc6']
+lelylijn_layers = [QgsProject.instance().mapLayersByName(name)[0] for name in scenario_names]
+
+# Baseline relationships layer to merge the scenarios into (delta mode), set to None to only compute the Lelylijn relationships;
+# the outputs are named 'POI_SAP_Relationships_<scenario>', list them in PTAL_analysis.py and PTAL_score.py to score them
+baseline_layer_name = 'POI_SAP_Relationships'
+baseline_layer = None
+if baseline_layer_name is not None:
+    if baseline_layer_name in [f"POI_SAP_Relationships_{name}" for name in scenario_names]:
+        raise Exception(f"Layer '{baseline_layer_name}' is a scenario output, not a baseline!")
+    baseline_layers = QgsProject.instance().mapLayersByName(baseline_layer_name)
+    if not baseline_layers:
+        raise Exception(f"Layer '{baseline_layer_name}' not found!")
+    baseline_layer = baseline_layers[0]
+
+# Create a new output layer for the results of every scenario
+output_layers = []
+for lelylijn_layer in lelylijn_layers:
+    output_layer = QgsVectorLayer(f"Point?crs={poi_layer.crs().authid()}", f"POI_SAP_Relationships_{lelylijn_layer.name()}", "memory")
+    output_provider = output_layer.dataProvider()
+
+    # Add fields from the POI and SAP layers, or the baseline fields when merging into the baseline
+    if baseline_layer:
+        output_provider.addAttributes(baseline_layer.fields().toList())
+    else:
+        poi_fields = [QgsField("POI_ID", QVariant.Int)]
+        sap_fields = [QgsField(relationship_field_name(field.name()), field.type()) for field in lelylijn_layer.fields()]
+        distance_field = [QgsField("Distance", QVariant.Double)]
+        output_provider.addAttributes(poi_fields + distance_field + sap_fields)
+    output_layer.updateFields()
+    output_layers.append(output_layer)
+
+# Create and schedule the task (use mode=SAP_CENTRIC to search from the SAPs, faster for dense POI sets,
+# set workers to the number of cores to process spatial tiles of POIs in parallel
+# set distance_cache_path to a .sqlite file to reuse network distances between runs
+# and batch_size to the number of rows added to the output layers at once)
+task = ProcessPOITask(poi_layer, road_network, lelylijn_layers, output_layers, baseline_layer)
 QgsApplication.taskManager().addTask(task)
@@ -3,9 +3,18 @@ from qgis.core import (
     QgsVectorLayer,
     QgsField,
     QgsFeature,
-    QgsVectorDataProvider
+    QgsFeatureRequest
 )
 from PyQt5.QtCore import QVariant
+import os
+import sys
+
+# Make the helper modules next to this script importable from the QGIS Python console
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+if SCRIPT_DIR not in sys.path:
+    sys.path.append(SCRIPT_DIR)
+
+from ptal_calc import calculate_ai_columns
 
 # Load the base POI layer
 poi_layer_name = 'POI'  # Replace with your actual POI layer name
@@ -14,63 +23,61 @@ poi_layer = QgsProject.instance().mapLayersByName(poi_layer_name)[0]
 if not poi_layer:
     raise Exception(f"Layer '{poi_layer_name}' not found!")
 
-# Load the relationships layer
-relationships_layer_name = 'POI_SAP_Relationships'  # Replace with your actual relationships layer name
-relationships_layer = QgsProject.instance().mapLayersByName(relationships_layer_name)[0]
-
-if not relationships_layer:
-    raise Exception(f"Layer '{relationships_layer_name}' not found!")
+# Collect the POI ids and geometries of the POI layer
+poi_ids = []
+geometries = []
+for poi_feature in poi_layer.getFeatures():
+    poi_ids.append(poi_feature["fid"])
+    geometries.append(poi_feature.geometry())
 
-# Create a new layer for PTAL with the same CRS and geometry type as the POI layer
-crs = poi_layer.crs().authid()  # Get the CRS of the POI layer
-geometry_type = "Point"  # Assuming the POI layer is a point layer
-ptal_layer = QgsVectorLayer(f"{geometry_type}?crs={crs}", "PTAL", "memory")
-provider = ptal_layer.dataProvider()
-provider.addAttributes([
-    QgsField("POI_ID", QVariant.Int),
-    QgsField("AI_bus", QVariant.Double),
-    QgsField("AI_trein", QVariant.Double),
-    QgsField("PTAI", QVariant.Double)
-])
-ptal_layer.updateFields()
+# Relationships layers to score, add the scenario outputs of POI_SAP_Relationships_adding_LL.py
+# (e.g. 'POI_SAP_Relationships_Lelylijn_sc1', scored into a 'PTAL_Lelylijn_sc1' layer) to score them in the same run
+relationships_layer_names = ['POI_SAP_Relationships']
 
-# Group features by POI_ID and route_type in the relationships layer
-def calculate_ai(features):
-    edf_values = [f["EDF"] for f in features if f["EDF"] is not None]
-    if not edf_values:
-        return 0
-    largest_edf = max(edf_values)
-    remaining_sum = sum(edf_values) - largest_edf
-    return largest_edf + 0.5 * remaining_sum
+for relationships_layer_name in relationships_layer_names:
+    relationships_layers = QgsProject.instance().mapLayersByName(relationships_layer_name)
+    if not relationships_layers:
+        raise Exception(f"Layer '{relationships_layer_name}' not found!")
+    relationships_layer = relationships_layers[0]
+    ptal_layer_name = relationships_layer_name.replace('POI_SAP_Relationships', 'PTAL', 1)
 
-relationships_groups = {}
-for feature in relationships_layer.getFeatures():
-    poi_id = feature["POI_ID"]
-    route_type = feature["route_type"].lower() if feature["route_type"] else None
-    if poi_id not in relationships_groups:
-        relationships_groups[poi_id] = {"bus": [], "trein": []}
-    if route_type == "bus":
-        relationships_groups[poi_id]["bus"].append(feature)
-    elif route_type == "trein":
-        relationships_groups[poi_id]["trein"].append(feature)
+    # Create a new PTAL layer with the same CRS and geometry type as the POI layer
+    crs = poi_layer.crs().authid()  # Get the CRS of the POI layer
+    geometry_type = "Point"  # Assuming the POI layer is a point layer
+    ptal_layer = QgsVectorLayer(f"{geometry_type}?crs={crs}", ptal_layer_name, "memory")
+    provider = ptal_layer.dataProvider()
+    provider.addAttributes([
+        QgsField("POI_ID", QVariant.Int),
+        QgsField("AI_bus", QVariant.Double),
+        QgsField("AI_trein", QVariant.Double),
+        QgsField("PTAI", QVariant.Double)
+    ])
+    ptal_layer.updateFields()
 
-# Calculate AI and PTAI for each POI_ID in the POI layer
-for poi_feature in poi_layer.getFeatures():
-    poi_id = poi_feature["fid"]
-    geometry = poi_feature.geometry()
+    # Read the POI_ID, route_type and EDF columns of the relationships layer, without geometries
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(['POI_ID', 'route_type', 'EDF'], relationships_layer.fields())
+    relationship_poi_ids = []
+    route_types = []
+    edf_values = []
+    for feature in relationships_layer.getFeatures(request):
+        relationship_poi_ids.append(feature["POI_ID"])
+        route_types.append(feature["route_type"])
+        edf_values.append(feature["EDF"])
 
-    groups = relationships_groups.get(poi_id, {"bus": [], "trein": []})  # Default to empty groups if missing
-    ai_bus = calculate_ai(groups["bus"])
-    ai_trein = calculate_ai(groups["trein"])
+    # Calculate AI for every POI_ID and mode at once, and PTAI
+    ai_bus, ai_trein = calculate_ai_columns(poi_ids, relationship_poi_ids, route_types, edf_values)
     ptai = ai_bus + ai_trein
 
-    # Add a new feature to the PTAL layer
-    new_feature = QgsFeature(ptal_layer.fields())
-    new_feature.setGeometry(geometry)
-    new_feature.setAttributes([poi_id, ai_bus, ai_trein, ptai])
-    provider.addFeature(new_feature)
+    # Add the new features to the PTAL layer in one call
+    new_features = []
+    for poi_id, geometry, values in zip(poi_ids, geometries, zip(ai_bus.tolist(), ai_trein.tolist(), ptai.tolist())):
+        new_feature = QgsFeature(ptal_layer.fields())
+        new_feature.setGeometry(geometry)
+        new_feature.setAttributes([poi_id, *values])
+        new_features.append(new_feature)
+    provider.addFeatures(new_features)
 
-# Add the new PTAL layer to the project
-QgsProject.instance().addMapLayer(ptal_layer)
+    # Add the new PTAL layer to the project
+    QgsProject.instance().addMapLayer(ptal_layer)
 
-print("PTAL layer created with columns POI_ID, AI_bus, AI_trein, and PTAI using POI layer as base.")
+    print(f"PTAL layer '{ptal_layer_name}' created with columns POI_ID, AI_bus, AI_trein, and PTAI using POI layer as base.")
@@ -0,0 +1,115 @@
+from qgis.core import Qgis, QgsProject, QgsField, QgsVectorLayer, QgsFeature, QgsTask, QgsApplication, QgsMessageLog
+from PyQt5.QtCore import QVariant
+import itertools
+import multiprocessing
+import os
+import sys
+
+# Make the helper modules next to this script importable from the QGIS Python console
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+if SCRIPT_DIR not in sys.path:
+    sys.path.append(SCRIPT_DIR)
+
+# Worker processes have to start the bundled Python interpreter instead of QGIS itself
+if os.name == 'nt':
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+
+from ptal_stream import stream_ptal
+from qgis_layers import road_graph_for_layer
+from relationships import POI_CENTRIC
+
+# Calculates the PTAL layer in one pass, without the POI_SAP_Relationships layer:
+# the distances of every tile of POIs go straight into their AI_bus, AI_trein and PTAI,
+# which replaces running POI_SAP_Relationships.py, PTAL_analysis.py and PTAL_score.py
+class StreamPTALTask(QgsTask):
+    def __init__(self, poi_layer, road_network, sap_bus_layer, sap_trein_layer, ptal_layer, mode=POI_CENTRIC, workers=1, distance_cache_path=None, batch_size=50_000, description="Calculating PTAL"):
+        super().__init__(description)
+        self.poi_layer = poi_layer
+        self.road_network = road_network
+        self.sap_bus_layer = sap_bus_layer
+        self.sap_trein_layer = sap_trein_layer
+        self.ptal_layer = ptal_layer
+        self.total_pois = poi_layer.featureCount()
+        self.progress = 0
+        self.mode = mode
+        self.workers = workers
+        self.distance_cache_path = distance_cache_path
+        self.batch_size = batch_size
+        self.exception = None
+
+    def update_progress(self, step=1):
+        self.progress += step
+        self.setProgress((self.progress / max(self.total_pois, 1)) * 100)
+
+    def run(self):
+        try:
+            # Reuse the road graph of this network, every search runs on it
+            road_graph = road_graph_for_layer(self.road_network)
+
+            def sap_layer_values(sap_layer, max_distance):
+                # Collect the SAP points with the route type and frequency the EDF needs
+                saps = []
+                sap_values = {}
+                for sap_feature in sap_layer.getFeatures():
+                    sap_point = sap_feature.geometry().asPoint()
+                    saps.append((sap_feature.id(), sap_point.x(), sap_point.y()))
+                    # NULL values become None so the values can be sent to worker processes
+                    sap_values[sap_feature.id()] = (sap_feature['route_type'] or None, sap_feature['frequency'] or None)
+                return saps, sap_values, max_distance
+
+            # Map every POI with a valid geometry to that geometry, the others get a PTAI of 0
+            poi_geometries = {}
+            for poi_feature in self.poi_layer.getFeatures():
+                geometry = poi_feature.geometry()
+                poi_geometries[poi_feature['fid']] = geometry
+            pois = [(poi_id, geometry.asPoint().x(), geometry.asPoint().y()) for poi_id, geometry in poi_geometries.items() if geometry.isGeosValid()]
+            missing = [(poi_id, 0.0, 0.0, 0.0) for poi_id, geometry in poi_geometries.items() if not geometry.isGeosValid()]
+
+            sap_layers = [sap_layer_values(self.sap_bus_layer, 400), sap_layer_values(self.sap_trein_layer, 3000)]
+            rows = stream_ptal(road_graph, pois, sap_layers, self.mode, self.workers, progress=self.update_progress, cache_path=self.distance_cache_path)
+
+            # Add the PTAL features in batches as their tiles finish, a cancelled task stops after the row it is working on
+            provider = self.ptal_layer.dataProvider()
+            new_features = []
+            for row in itertools.chain(rows, missing):
+                if self.isCanceled():
+                    return False
+                new_feature = QgsFeature(self.ptal_layer.fields())
+                new_feature.setGeometry(poi_geometries[row[0]])
+                new_feature.setAttributes(list(row))
+                new_features.append(new_feature)
+                if len(new_features) >= self.batch_size:
+                    provider.addFeatures(new_features)
+                    new_features = []
+            provider.addFeatures(new_features)
+
+            return not self.isCanceled()
+        except Exception as exception:
+            self.exception = exception
+            return False
+
+    def finished(self, result):
+        if result:
+            QgsProject.instance().addMapLayer(self.ptal_layer)
+        elif self.exception is not None:
+            QgsMessageLog.logMessage(f"Calculating PTAL failed: {self.exception!r}", "PTAL", Qgis.Critical)
+
+# Main script
+poi_layer = QgsProject.instance().mapLayersByName('POI')[0]
+road_network = QgsProject.instance().mapLayersByName('hartlijn_fiets_voet')[0]
+sap_bus_layer = QgsProject.instance().mapLayersByName('SAP_bus')[0]
+sap_trein_layer = QgsProject.instance().mapLayersByName('SAP_trein')[0]
+
+# Create the PTAL layer with the same fields as PTAL_score.py
+ptal_layer = QgsVectorLayer(f"Point?crs={poi_layer.crs().authid()}", "PTAL", "memory")
+ptal_layer.dataProvider().addAttributes([
+    QgsField("POI_ID", QVariant.Int),
+    QgsField("AI_bus", QVariant.Double),
+    QgsField("AI_trein", QVariant.Double),
+    QgsField("PTAI", QVariant.Double)
+])
+ptal_layer.updateFields()
+
+# Create and schedule the task (mode, workers, distance_cache_path and batch_size work as in POI_SAP_Relationships.py)
+task = StreamPTALTask(poi_layer, road_network, sap_bus_layer, sap_trein_layer, ptal_layer)
+QgsApplication.taskManager().addTask(task)
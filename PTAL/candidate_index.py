@@ -0,0 +1,30 @@
+import numpy as np
+import shapely
+
+
+class CandidateIndex:
+    """STRtree over SAP or POI points, built once per run.
+
+    Replaces clipping a layer with a temporary buffer layer: a lookup returns the
+    ids of all geometries within a radius of a point.
+    """
+
+    def __init__(self, ids, geometries):
+        self.ids = np.asarray(ids)
+        self.tree = shapely.STRtree(geometries)
+
+    @classmethod
+    def from_points(cls, ids, coords):
+        return cls(ids, shapely.points(np.asarray(coords, dtype=np.float64).reshape(-1, 2)))
+
+    def within(self, x, y, radius):
+        """Return the ids of the geometries within radius of (x, y), in input order."""
+        found = self.tree.query(shapely.points(x, y), predicate='dwithin', distance=radius)
+        return self.ids[np.sort(found)].tolist()
+
+    def within_many(self, coords, radius):
+        """Return (point index, id) arrays for all geometries within radius of each point."""
+        points = shapely.points(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+        point_index, found = self.tree.query(points, predicate='dwithin', distance=radius)
+        order = np.lexsort((found, point_index))
+        return point_index[order], self.ids[found[order]]
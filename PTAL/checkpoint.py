@@ -0,0 +1,44 @@
+import sqlite3
+
+
+class Checkpoint:
+    """On-disk record of the POIs a relationships run has finished, with their rows, in SQLite.
+
+    A run is split in steps, such as one SAP layer, and every step in tiles of
+    POIs. The rows and POIs of a tile are written in one transaction, so after a
+    crash or a cancel the file holds whole tiles only; a resumed run takes the
+    rows of the finished POIs from here and only searches the others. The file
+    belongs to one road network, delete it to start a run from scratch.
+    """
+
+    def __init__(self, path, network_hash):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pois (step TEXT, poi_id, PRIMARY KEY (step, poi_id)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS rows (step TEXT, poi_id, sap_id, distance REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS rows_step ON rows (step)")
+        self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('network_hash', ?)", (network_hash,))
+        self.connection.commit()
+
+        stored_hash = self.connection.execute("SELECT value FROM meta WHERE key = 'network_hash'").fetchone()[0]
+        if stored_hash != network_hash:
+            self.connection.close()
+            raise ValueError(f'{path} is the checkpoint of a run on another road network')
+
+    def done(self, step):
+        """Return the set of POI ids that are finished in step."""
+        return {poi_id for poi_id, in self.connection.execute("SELECT poi_id FROM pois WHERE step = ?", (step,))}
+
+    def rows(self, step):
+        """Return an iterator over the (poi_id, sap_id, distance) rows stored for step."""
+        return self.connection.execute("SELECT poi_id, sap_id, distance FROM rows WHERE step = ?", (step,))
+
+    def add(self, step, poi_ids, rows):
+        """Store the rows of finished POIs and mark those POIs as done, in one transaction."""
+        with self.connection:
+            self.connection.executemany("INSERT INTO rows VALUES (?, ?, ?, ?)", ((step, *row) for row in rows))
+            self.connection.executemany("INSERT OR IGNORE INTO pois VALUES (?, ?)", ((step, poi_id) for poi_id in poi_ids))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,98 @@
+import sqlite3
+
+
+def snap_key(snap):
+    """Key of a snapped POI or SAP position, points that snap to the same spot share their distances."""
+    return f"{snap.edge}:{snap.t:.9f}"
+
+
+class DistanceCache:
+    """On-disk cache of POI-SAP network distances in SQLite.
+
+    Entries are keyed by the road network hash and the snapped POI and SAP
+    positions, so they survive re-runs, extra scenarios and resumed jobs on the
+    same network, and a POI that is moved gets new entries instead of the
+    distances of its old position. A distance of None means the SAP was not reached within the
+    max_distance that was searched. When the cache grows past max_entries rows
+    the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, network_hash, max_entries=50_000_000):
+        self.network_hash = network_hash
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS snap_distances ("
+            "network TEXT, poi_key TEXT, sap_key TEXT, max_distance REAL, distance REAL, used INTEGER, "
+            "PRIMARY KEY (network, poi_key, sap_key)) WITHOUT ROWID"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS snap_distances_used ON snap_distances (used)")
+        self.connection.commit()
+
+        # Every flush advances the clock, rows that were used or stored get the current time
+        self.clock = (self.connection.execute("SELECT MAX(used) FROM snap_distances").fetchone()[0] or 0) + 1
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM snap_distances").fetchone()[0]
+        self.pending = []
+        self.hits = []
+
+    def lookup(self, poi_key, sap_keys, max_distance):
+        """Return {sap_key: distance or None} for the keys with a cached answer valid for max_distance."""
+        if not sap_keys:
+            return {}
+        placeholders = ','.join('?' * len(sap_keys))
+        rows = self.connection.execute(
+            f"SELECT sap_key, max_distance, distance FROM snap_distances WHERE network = ? AND poi_key = ? AND sap_key IN ({placeholders})",
+            [self.network_hash, poi_key, *sap_keys],
+        ).fetchall()
+
+        found = {}
+        for sap_key, searched, distance in rows:
+            # A reached SAP is valid for any radius, an unreached one only up to the radius that was searched
+            if distance is not None:
+                found[sap_key] = distance if distance <= max_distance else None
+            elif searched >= max_distance:
+                found[sap_key] = None
+            else:
+                continue
+            self.hits.append((self.clock, self.network_hash, poi_key, sap_key))
+        return found
+
+    def store(self, poi_key, distances, max_distance):
+        """Queue {sap_key: distance or None} results of a search up to max_distance, written on flush."""
+        for sap_key, distance in distances.items():
+            self.pending.append((self.network_hash, poi_key, sap_key, max_distance, distance, self.clock))
+
+    def flush(self):
+        """Write queued results and hits, then evict the least recently used rows if the cache is full."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO snap_distances VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO UPDATE SET "
+                "max_distance = excluded.max_distance, distance = excluded.distance, used = excluded.used",
+                self.pending,
+            )
+            self.connection.executemany(
+                "UPDATE snap_distances SET used = ? WHERE network = ? AND poi_key = ? AND sap_key = ?",
+                self.hits,
+            )
+        self.entries += len(self.pending)
+        self.pending = []
+        self.hits = []
+        self.clock += 1
+
+        if self.entries > self.max_entries:
+            self.entries = self.connection.execute("SELECT COUNT(*) FROM snap_distances").fetchone()[0]
+            if self.entries > self.max_entries:
+                # Evict down to 90% of the limit so eviction does not run on every flush
+                excess = self.entries - int(self.max_entries * 0.9)
+                with self.connection:
+                    self.connection.execute(
+                        "DELETE FROM snap_distances WHERE (network, poi_key, sap_key) IN "
+                        "(SELECT network, poi_key, sap_key FROM snap_distances ORDER BY used LIMIT ?)",
+                        (excess,),
+                    )
+                self.entries -= excess
+
+    def close(self):
+        self.flush()
+        self.connection.close()
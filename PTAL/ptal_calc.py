@@ -0,0 +1,145 @@
+"""Shared PTAL calculations, used by the QGIS scripts and the headless pipeline.
+
+Features can be QGIS features or any mapping with the same field names.
+"""
+import numpy as np
+
+# Parameters of the mode choice, travel time and waiting time calculation
+PTAL_PARAMETERS = {
+    'walking_speed': 80,  # meters per minute
+    'cycling_speed': 300,  # meters per minute
+    'walking_cutoff': 800,  # train stations further away than this are reached by bike
+    'reliability_trein': 0.75,  # minutes added to the SWT of trains
+    'reliability_bus': 2,  # minutes added to the SWT of buses and other modes
+}
+
+def assign_transport_mode_and_time(feature):
+    """Return the transport mode, TT, SWT, AWT, TAT and EDF of one relationship feature, None where they do not apply."""
+    route_type = feature['route_type'].lower() if feature['route_type'] else ''
+    distance = feature['Distance']
+    frequency = feature['frequency']
+
+    transport_mode = None
+    travel_time = None
+    swt = None
+    awt = None
+    tat = None
+    edf = None
+
+    if route_type == 'bus':
+        transport_mode = 'walking'
+        travel_time = distance / PTAL_PARAMETERS['walking_speed']
+
+    elif route_type == 'trein':
+        if distance <= PTAL_PARAMETERS['walking_cutoff']:
+            transport_mode = 'walking'
+            travel_time = distance / PTAL_PARAMETERS['walking_speed']
+        else:
+            transport_mode = 'cycling'
+            travel_time = distance / PTAL_PARAMETERS['cycling_speed']
+
+    # Calculate SWT
+    if frequency > 0:
+        swt = 0.5 * (60 / frequency)
+
+    # Calculate AWT
+    if swt is not None:
+        if route_type == 'trein':
+            awt = swt + PTAL_PARAMETERS['reliability_trein']
+        else:
+            awt = swt + PTAL_PARAMETERS['reliability_bus']
+
+    # Calculate TAT
+    if travel_time is not None and awt is not None:
+        tat = travel_time + awt
+
+    # Calculate EDF
+    if tat is not None and tat > 0:
+        edf = 0.5 * (60 / tat)
+
+    return transport_mode, travel_time, swt, awt, tat, edf
+
+
+def _float_column(values):
+    # None and QGIS NULL values become NaN
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([value if isinstance(value, (int, float)) else np.nan for value in values], dtype=np.float64)
+
+
+def assign_transport_mode_and_time_columns(route_types, distances, frequencies, parameters=PTAL_PARAMETERS):
+    """Column-wise version of assign_transport_mode_and_time for whole relationship tables.
+
+    Takes sequences of route types, distances and frequencies and returns a dict
+    with the transport_mode column (None where there is no mode) and float
+    columns TT, SWT, AWT, TAT and EDF (NaN where the row version returns None).
+    """
+    route_types = np.array([value.lower() if isinstance(value, str) else '' for value in route_types])
+    distances = _float_column(distances)
+    frequencies = _float_column(frequencies)
+    is_bus = route_types == 'bus'
+    is_trein = route_types == 'trein'
+
+    # Buses and nearby train stations are walked to, other train stations are cycled to
+    walking = is_bus | (is_trein & (distances <= parameters['walking_cutoff']))
+    cycling = is_trein & ~walking
+    transport_mode = np.full(len(route_types), None, dtype=object)
+    transport_mode[walking] = 'walking'
+    transport_mode[cycling] = 'cycling'
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        travel_time = np.where(walking, distances / parameters['walking_speed'], np.where(cycling, distances / parameters['cycling_speed'], np.nan))
+        swt = np.where(frequencies > 0, 0.5 * (60 / frequencies), np.nan)
+        awt = swt + np.where(is_trein, parameters['reliability_trein'], parameters['reliability_bus'])
+        tat = travel_time + awt
+        edf = np.where(tat > 0, 0.5 * (60 / tat), np.nan)
+
+    return {'transport_mode': transport_mode, 'TT': travel_time, 'SWT': swt, 'AWT': awt, 'TAT': tat, 'EDF': edf}
+
+
+def calculate_ai(features):
+    """Accessibility index of one mode: the best EDF plus half of all the others."""
+    edf_values = [f["EDF"] for f in features if f["EDF"] is not None]
+    if not edf_values:
+        return 0
+    largest_edf = max(edf_values)
+    remaining_sum = sum(edf_values) - largest_edf
+    return largest_edf + 0.5 * remaining_sum
+
+
+def calculate_ai_columns(poi_ids, relationship_poi_ids, route_types, edf_values):
+    """Column-wise version of calculate_ai for all POIs and both modes at once.
+
+    Sorts the (POI, mode) pairs of the relationship rows and reduces every
+    segment with np.maximum.reduceat and np.add.reduceat. Returns the AI_bus and
+    AI_trein arrays in the order of poi_ids, 0 for POIs without relationships.
+    """
+    poi_ids = np.asarray(poi_ids)
+    relationship_poi_ids = np.asarray(relationship_poi_ids)
+    route_types = np.array([value.lower() if isinstance(value, str) else '' for value in route_types])
+    edf_values = _float_column(edf_values)
+    ai = np.zeros((len(poi_ids), 2), dtype=np.float64)
+    if not len(poi_ids) or not len(relationship_poi_ids):
+        return ai[:, 0], ai[:, 1]
+
+    # Position of every row's POI, rows of unknown POIs, other modes or without EDF are left out
+    order = np.argsort(poi_ids, kind='stable')
+    positions = np.clip(np.searchsorted(poi_ids, relationship_poi_ids, sorter=order), 0, len(poi_ids) - 1)
+    positions = order[positions]
+    modes = np.where(route_types == 'bus', 0, np.where(route_types == 'trein', 1, -1))
+    keep = (poi_ids[positions] == relationship_poi_ids) & (modes >= 0) & ~np.isnan(edf_values)
+    keys = positions[keep] * 2 + modes[keep]
+    edf_values = edf_values[keep]
+    if not len(keys):
+        return ai[:, 0], ai[:, 1]
+
+    # One segment per POI and mode: the best EDF plus half of all the others
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    edf_values = edf_values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    largest = np.maximum.reduceat(edf_values, starts)
+    total = np.add.reduceat(edf_values, starts)
+    ai.reshape(-1)[keys[starts]] = largest + 0.5 * (total - largest)
+    return ai[:, 0], ai[:, 1]
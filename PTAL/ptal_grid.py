@@ -0,0 +1,156 @@
+"""Gridded PTAL: AI_bus, AI_trein and PTAI for every cell of a regular grid, as memory-mapped float32 rasters.
+
+The centre of every cell is handled like a POI by ptal_stream.ptal_for_pois, so
+the scores follow calculate_ai of PTAL_score.py. The grid is processed in square
+tiles of cells; every finished tile is written into its window of the rasters,
+so memory follows the size of a tile and not the size of the grid. Row 0 is the
+northern edge of the grid, like in a GeoTIFF. Cells whose centre is further
+than the maximum snap distance from the road network, such as cells in water,
+are not reachable and get NaN, the nodata value of the rasters.
+"""
+import json
+import math
+import multiprocessing
+import os
+
+import numpy as np
+
+from ptal_stream import ptal_for_pois
+from relationships import SAP_CENTRIC, init_worker, worker_state
+
+# Rasters written by grid_ptal, one .npy file each
+GRID_LAYERS = ['AI_bus', 'AI_trein', 'PTAI']
+
+
+def grid_shape(extent, cell_size):
+    """Return the (rows, columns) of a grid of cell_size squares covering extent (xmin, ymin, xmax, ymax)."""
+    xmin, ymin, xmax, ymax = extent
+    return max(math.ceil((ymax - ymin) / cell_size), 1), max(math.ceil((xmax - xmin) / cell_size), 1)
+
+
+def _grid_windows(shape, tile_cells):
+    # (row, column, rows, columns) of every tile, row by row
+    rows, columns = shape
+    for row in range(0, rows, tile_cells):
+        for column in range(0, columns, tile_cells):
+            yield row, column, min(tile_cells, rows - row), min(tile_cells, columns - column)
+
+
+def _window_ptal(road_graph, sap_layers, extent, cell_size, window, mode, max_snap_distance):
+    # AI_bus, AI_trein and PTAI of the cells in one window, as a (3, rows, columns) float32 array
+    row, column, rows, columns = window
+    xmin, _, _, ymax = extent
+    x = xmin + (column + np.arange(columns) + 0.5) * cell_size
+    y = ymax - (row + np.arange(rows) + 0.5) * cell_size
+
+    # Cells are numbered row by row within the window; cells off the network are nodata
+    cell_x, cell_y = np.meshgrid(x, y)
+    cell_x, cell_y = cell_x.ravel().tolist(), cell_y.ravel().tolist()
+    cell_keys = [key for key in zip(cell_x, cell_y) if key not in road_graph.snap_cache]
+    _, _, offsets = road_graph.snap_many(list(zip(cell_x, cell_y)))
+    covered = offsets <= max_snap_distance
+    ai = np.zeros((len(GRID_LAYERS), rows * columns), dtype=np.float32)
+    ai[:, ~covered] = np.nan
+
+    # The SAPs of every layer in a halo of its max_distance around the window; without any the covered cells stay 0
+    tile_layers = []
+    for saps, sap_values, sap_coords, max_distance in sap_layers:
+        halo = np.flatnonzero(
+            (sap_coords[:, 0] >= x[0] - cell_size / 2 - max_distance) & (sap_coords[:, 0] <= x[-1] + cell_size / 2 + max_distance)
+            & (sap_coords[:, 1] >= y[-1] - cell_size / 2 - max_distance) & (sap_coords[:, 1] <= y[0] + cell_size / 2 + max_distance)
+        )
+        if len(halo):
+            tile_layers.append(([saps[k] for k in halo], sap_values, max_distance))
+    cells = [(k, cell_x[k], cell_y[k]) for k in np.flatnonzero(covered).tolist()]
+    if tile_layers and cells:
+        scores = ptal_for_pois(road_graph, cells, tile_layers, mode)
+        ai[:, covered] = np.array([score[1:] for score in scores], dtype=np.float32).T
+
+    # The snaps of the cells are not needed again, dropping them keeps the memory of the graph bounded;
+    # the SAP snaps stay cached for the next windows
+    for key in cell_keys:
+        road_graph.snap_cache.pop(key, None)
+    return ai.reshape(len(GRID_LAYERS), rows, columns)
+
+
+# SAP layers and grid of a worker process, set once by the pool initializer
+_worker_sap_layers = None
+_worker_grid = None
+
+
+def _init_worker(road_graph, sap_layers, grid):
+    global _worker_sap_layers, _worker_grid
+    init_worker(road_graph)
+    _worker_sap_layers = sap_layers
+    _worker_grid = grid
+
+
+def _worker_window(window):
+    extent, cell_size, mode, max_snap_distance = _worker_grid
+    road_graph, _ = worker_state()
+    return window, _window_ptal(road_graph, _worker_sap_layers, extent, cell_size, window, mode, max_snap_distance)
+
+
+def grid_ptal(road_graph, extent, cell_size, sap_layers, path, mode=SAP_CENTRIC, workers=1, tile_cells=256, progress=None, crs=None, max_snap_distance=None):
+    """Write the PTAL of a grid of cell_size squares over extent (xmin, ymin, xmax, ymax) to the directory path.
+
+    sap_layers is a list of (saps, sap_values, max_distance) like for
+    stream_ptal. Every layer of GRID_LAYERS becomes a float32 .npy raster of
+    grid_shape(extent, cell_size); meta.json, written last, holds the extent,
+    cell size, crs and maximum snap distance. Tiles of tile_cells x tile_cells cells run in a process
+    pool with workers > 1, progress is called with the number of cells of every
+    finished tile. One search per SAP (SAP_CENTRIC) suits the dense cells best.
+    Cells further than max_snap_distance from the road network are NaN; by
+    default that is half the diagonal of a cell, so a cell is covered when the
+    network passes within reach of its corners.
+    """
+    if max_snap_distance is None:
+        max_snap_distance = cell_size * math.sqrt(2) / 2
+    shape = grid_shape(extent, cell_size)
+    xmin, _, _, ymax = extent
+    # The grid starts at the top left corner of extent and may run a little past its right and bottom edges
+    extent = (xmin, ymax - shape[0] * cell_size, xmin + shape[1] * cell_size, ymax)
+    sap_layers = [(list(saps), sap_values, np.array([(x, y) for _, x, y in saps], dtype=np.float64).reshape(-1, 2), max_distance) for saps, sap_values, max_distance in sap_layers]
+
+    os.makedirs(path, exist_ok=True)
+    rasters = [np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=np.float32, shape=shape) for name in GRID_LAYERS]
+
+    def write(window, ai):
+        row, column, rows, columns = window
+        for raster, values in zip(rasters, ai):
+            raster[row:row + rows, column:column + columns] = values
+        if progress is not None:
+            progress(rows * columns)
+
+    windows = _grid_windows(shape, tile_cells)
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(road_graph, sap_layers, (extent, cell_size, mode, max_snap_distance))) as pool:
+            for window, ai in pool.imap_unordered(_worker_window, windows):
+                write(window, ai)
+    else:
+        for window in windows:
+            write(window, _window_ptal(road_graph, sap_layers, extent, cell_size, window, mode, max_snap_distance))
+
+    for raster in rasters:
+        raster.flush()
+    del rasters
+    # Written last, a grid without meta.json is incomplete
+    with open(os.path.join(path, 'meta.json'), 'w') as meta:
+        json.dump({'extent': list(extent), 'cell_size': cell_size, 'shape': list(shape), 'crs': crs, 'layers': GRID_LAYERS, 'max_snap_distance': max_snap_distance, 'nodata': 'nan'}, meta)
+
+
+class PTALGrid:
+    """Memory-mapped rasters from grid_ptal, by layer name."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as meta:
+            meta = json.load(meta)
+        self.extent = tuple(meta['extent'])
+        self.cell_size = meta['cell_size']
+        self.crs = meta['crs']
+        self.layers = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in meta['layers']}
+
+    def cell(self, x, y):
+        """Return the (row, column) of the cell that contains (x, y)."""
+        xmin, _, _, ymax = self.extent
+        return int((ymax - y) // self.cell_size), int((x - xmin) // self.cell_size)
@@ -0,0 +1,328 @@
+"""Headless PTAL pipeline: relationships, transport mode and time, and AI scores without QGIS.
+
+Example:
+    python ptal_pipeline.py --poi data.gpkg|layername=POI --roads data.gpkg|layername=hartlijn_fiets_voet
+        --sap-bus data.gpkg|layername=SAP_bus --sap-trein data.gpkg|layername=SAP_trein --output PTAL.gpkg
+"""
+import argparse
+import itertools
+import os
+from array import array
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+
+from distance_cache import DistanceCache
+from ptal_calc import assign_transport_mode_and_time_columns, calculate_ai_columns
+from ptal_grid import grid_ptal, grid_shape
+from ptal_stream import stream_ptal
+from relationship_writer import COMPACT_SAP_FIELDS, SAP_FID_FIELD, FileSink, FrameWriter, RelationshipBuffer, sap_attribute_table
+from relationships import POI_CENTRIC, SAP_CENTRIC, relationships_from_pois, relationships_from_saps, relationships_in_parallel
+from road_graph import RoadGraph
+from scenarios import ScenarioRunner
+
+# Maximum access distance along the network for each SAP layer, the same as ProcessPOITask
+BUS_MAX_DISTANCE = 400
+TRAIN_MAX_DISTANCE = 3000
+
+ANALYSIS_FIELDS = ['transport_mode', 'TT', 'SWT', 'AWT', 'TAT', 'EDF']
+
+
+def _split_source(source):
+    # Accept QGIS style sources such as 'data.gpkg|layername=POI'
+    path, _, options = str(source).partition('|')
+    layer = options.split('=', 1)[1] if options.startswith('layername=') else None
+    return path, layer
+
+
+def read_layer(source):
+    """Read a GeoPackage layer or GeoParquet file, indexed by its feature ids ('fid')."""
+    path, layer = _split_source(source)
+    if path.endswith('.parquet'):
+        frame = gpd.read_parquet(path)
+        if 'fid' in frame.columns:
+            frame = frame.set_index('fid')
+    else:
+        frame = gpd.read_file(path, layer=layer, fid_as_index=True)
+    frame.index.name = 'fid'
+    return frame
+
+
+def read_relationships(source):
+    """Read a POI_SAP_Relationships table, with or without POI geometry, from a GeoPackage or Parquet file.
+
+    Tables from QGIS runs before the SAP fid was stored as SAP_FID_FIELD have it
+    as a fid column, which is renamed so all relationships share one schema.
+    """
+    path, layer = _split_source(source)
+    if path.endswith('.parquet'):
+        metadata = pq.read_schema(path).metadata or {}
+        frame = gpd.read_parquet(path) if b'geo' in metadata else pd.read_parquet(path)
+    else:
+        frame = gpd.read_file(path, layer=layer)
+    return frame.rename(columns={'fid': SAP_FID_FIELD})
+
+
+def write_layer(frame, source):
+    """Write a layer or table to a GeoPackage or (Geo)Parquet file."""
+    path, layer = _split_source(source)
+    if path.endswith('.parquet'):
+        frame.to_parquet(path)
+    elif isinstance(frame, gpd.GeoDataFrame):
+        frame.to_file(path, layer=layer, driver='GPKG')
+    else:
+        # Tables without geometry, such as compact relationships
+        pyogrio.write_dataframe(frame, path, layer=layer, driver='GPKG')
+
+
+def road_graph_from_frame(roads):
+    """Build the road graph from the line geometries of a GeoDataFrame."""
+    parts = shapely.get_parts(roads.geometry.to_numpy())
+    coords, index = shapely.get_coordinates(parts, return_index=True)
+    return RoadGraph(np.split(coords, np.flatnonzero(np.diff(index)) + 1))
+
+
+def point_rows(frame):
+    """Return (fid, x, y) of every valid point in a GeoDataFrame."""
+    frame = frame[frame.geometry.is_valid & ~frame.geometry.is_empty]
+    return list(zip(frame.index.tolist(), frame.geometry.x.tolist(), frame.geometry.y.tolist()))
+
+
+def compute_relationships(road_graph, poi, sap_layers, mode=POI_CENTRIC, workers=1, cache_path=None, sink=None, batch_size=50_000):
+    """Compute the POI_SAP_Relationships table for a list of (SAP frame, max distance) pairs.
+
+    Returns a DataFrame with POI_ID, Distance and all SAP attributes, like the QGIS output layer.
+    With cache_path, network distances are reused from and stored in that SQLite file.
+    With a sink, such as a FileSink, the full rows are written to it in batches of batch_size
+    and only POI_ID, Distance and COMPACT_SAP_FIELDS, the columns the analysis needs, are returned.
+    """
+    pois = point_rows(poi)
+    distance_cache = DistanceCache(cache_path, road_graph.network_hash) if cache_path else None
+    tables = []
+    for sap, max_distance in sap_layers:
+        saps = point_rows(sap)
+        if workers > 1:
+            rows = relationships_in_parallel(road_graph, pois, saps, max_distance, mode, workers, cache_path=cache_path)
+        elif mode == SAP_CENTRIC:
+            rows = relationships_from_saps(road_graph, pois, saps, max_distance)
+        else:
+            rows = relationships_from_pois(road_graph, pois, saps, max_distance, distance_cache=distance_cache)
+        if sink is not None:
+            rows = _buffered(rows, RelationshipBuffer(sink, sap_attribute_table(sap), batch_size))
+            tables.append(_relationships_table(rows, sap, COMPACT_SAP_FIELDS))
+        else:
+            tables.append(_relationships_table(rows, sap))
+    if distance_cache:
+        distance_cache.close()
+    return pd.concat(tables, ignore_index=True)
+
+
+def _buffered(rows, buffer):
+    # Pass the rows on while they are written to the buffer, the last batch is flushed at the end
+    for row in rows:
+        buffer.add(*row)
+        yield row
+    buffer.flush()
+
+
+def _relationships_table(rows, sap, sap_fields=None):
+    # Turn (poi_id, sap_id, distance) rows into POI_ID, Distance and the SAP attributes, or only sap_fields of them;
+    # the rows are collected in columns, not as tuples
+    poi_ids, sap_ids, distances = [], [], array('d')
+    for poi_id, sap_id, distance in rows:
+        poi_ids.append(poi_id)
+        sap_ids.append(sap_id)
+        distances.append(distance)
+    attributes = sap_attribute_table(sap)
+    if sap_fields is not None:
+        attributes = attributes.reindex(columns=sap_fields)
+    attributes = attributes.loc[sap_ids].reset_index(drop=True)
+    return pd.concat([pd.DataFrame({'POI_ID': poi_ids, 'Distance': np.frombuffer(distances, dtype=np.float64)}), attributes], axis=1)
+
+
+def compute_scenario_relationships(scenario_runner, baseline_relationships, scenario_sap, max_distance=TRAIN_MAX_DISTANCE, mode=POI_CENTRIC, workers=1):
+    """Merge the relationships of new scenario stops into the baseline relationships.
+
+    Only POIs within max_distance of a new stop are searched; all other POIs keep their baseline rows.
+    """
+    scenario = _relationships_table(scenario_runner.relationships(point_rows(scenario_sap), max_distance, mode, workers), scenario_sap)
+    baseline = pd.DataFrame(baseline_relationships.drop(columns=[baseline_relationships.geometry.name] if isinstance(baseline_relationships, gpd.GeoDataFrame) else []))
+    return pd.concat([baseline.drop(columns=ANALYSIS_FIELDS, errors='ignore'), scenario], ignore_index=True)
+
+
+def run_scenarios(poi, roads, baseline_relationships, scenario_saps, mode=POI_CENTRIC, workers=1, cache_path=None):
+    """Run several scenarios in delta mode on one road graph, POI snapping and POI index.
+
+    scenario_saps maps scenario names to SAP frames with their new stops. Returns
+    the relationships and PTAL tables of all scenarios, with a scenario column.
+    """
+    scenario_runner = ScenarioRunner(road_graph_from_frame(roads), point_rows(poi), cache_path)
+    all_relationships = []
+    all_ptal = []
+    for name, scenario_sap in scenario_saps.items():
+        relationships = compute_scenario_relationships(scenario_runner, baseline_relationships, scenario_sap, mode=mode, workers=workers)
+        relationships = add_analysis_fields(relationships)
+        all_relationships.append(relationships.assign(scenario=name))
+        all_ptal.append(score_pois(poi, relationships).assign(scenario=name))
+    scenario_runner.close()
+    return pd.concat(all_relationships, ignore_index=True), pd.concat(all_ptal, ignore_index=True)
+
+
+def add_analysis_fields(relationships):
+    """Add the transport_mode, TT, SWT, AWT, TAT and EDF columns, as PTAL_analysis.py does."""
+    columns = assign_transport_mode_and_time_columns(relationships['route_type'], relationships['Distance'], relationships['frequency'])
+    analysis = pd.DataFrame(columns, columns=ANALYSIS_FIELDS, index=relationships.index)
+    return pd.concat([relationships.drop(columns=ANALYSIS_FIELDS, errors='ignore'), analysis], axis=1)
+
+
+def score_pois(poi, relationships):
+    """Return the PTAL layer with AI_bus, AI_trein and PTAI for every POI, as PTAL_score.py does."""
+    ai_bus, ai_trein = calculate_ai_columns(poi.index.to_numpy(), relationships['POI_ID'].to_numpy(), relationships['route_type'], relationships['EDF'])
+    table = pd.DataFrame({'POI_ID': poi.index.to_numpy(), 'AI_bus': ai_bus, 'AI_trein': ai_trein, 'PTAI': ai_bus + ai_trein})
+    return gpd.GeoDataFrame(table, geometry=poi.geometry.to_numpy(), crs=poi.crs)
+
+
+def run_pipeline(poi, roads, sap_bus, sap_trein, mode=POI_CENTRIC, workers=1, cache_path=None, sink=None, batch_size=50_000):
+    """Run relationships, analysis and scoring; returns (relationships, PTAL layer).
+
+    With a sink the relationships are streamed to it while they are computed, and
+    the returned relationships only hold the columns of the analysis.
+    """
+    road_graph = road_graph_from_frame(roads)
+    relationships = compute_relationships(road_graph, poi, [(sap_bus, BUS_MAX_DISTANCE), (sap_trein, TRAIN_MAX_DISTANCE)], mode, workers, cache_path, sink, batch_size)
+    relationships = add_analysis_fields(relationships)
+    return relationships, score_pois(poi, relationships)
+
+
+def stream_pipeline(poi, roads, sap_bus, sap_trein, output, mode=POI_CENTRIC, workers=1, cache_path=None, batch_size=50_000):
+    """Write the PTAL layer in one streaming pass, without a relationships table.
+
+    Network distances go straight through the EDF calculation into the AI of
+    their POI, and PTAL rows are written in batches of batch_size as their tiles
+    finish. POIs without a valid geometry get 0 at the end. Returns the number
+    of PTAL rows written.
+    """
+    road_graph = road_graph_from_frame(roads)
+    pois = point_rows(poi)
+    missing = poi.index.difference([poi_id for poi_id, _, _ in pois])
+    rows = stream_ptal(road_graph, pois, _sap_layers(sap_bus, sap_trein), mode, workers, cache_path=cache_path)
+
+    writer = FrameWriter(output)
+    count = 0
+    batch = []
+    for row in itertools.chain(rows, ((poi_id, 0.0, 0.0, 0.0) for poi_id in missing.tolist())):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += _write_ptal_batch(writer, poi, batch)
+            batch = []
+    if batch:
+        count += _write_ptal_batch(writer, poi, batch)
+    writer.close()
+    return count
+
+
+def _sap_layers(sap_bus, sap_trein):
+    # (saps, {sap_id: (route_type, frequency)}, max_distance) of both SAP layers, as stream_ptal and grid_ptal take them
+    return [(point_rows(sap), dict(zip(sap.index.tolist(), zip(sap['route_type'].tolist(), sap['frequency'].tolist()))), max_distance) for sap, max_distance in [(sap_bus, BUS_MAX_DISTANCE), (sap_trein, TRAIN_MAX_DISTANCE)]]
+
+
+def grid_pipeline(roads, sap_bus, sap_trein, output, cell_size, extent=None, mode=SAP_CENTRIC, workers=1, max_snap_distance=None):
+    """Write AI_bus, AI_trein and PTAI of a grid of cell_size squares as float32 rasters in the folder output.
+
+    The grid covers extent (xmin, ymin, xmax, ymax), by default the bounds of
+    the road network. Cells further than max_snap_distance from the network
+    are NaN, see grid_ptal. Returns the (rows, columns) of the rasters.
+    """
+    road_graph = road_graph_from_frame(roads)
+    extent = tuple(roads.total_bounds.tolist()) if extent is None else tuple(extent)
+    grid_ptal(road_graph, extent, cell_size, _sap_layers(sap_bus, sap_trein), output, mode, workers, crs=roads.crs.to_string() if roads.crs else None, max_snap_distance=max_snap_distance)
+    return grid_shape(extent, cell_size)
+
+
+def _write_ptal_batch(writer, poi, rows):
+    # Write PTAL rows with the geometry of their POI
+    table = pd.DataFrame(rows, columns=['POI_ID', 'AI_bus', 'AI_trein', 'PTAI'])
+    writer.write_frame(gpd.GeoDataFrame(table, geometry=poi.geometry.loc[table['POI_ID']].to_numpy(), crs=poi.crs))
+    return len(rows)
+
+
+def _scenario_name(source):
+    # Name a scenario after its layer, or after its file when there is no layer name
+    path, layer = _split_source(source)
+    return layer or os.path.splitext(os.path.basename(path))[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calculate PTAL scores without QGIS.")
+    parser.add_argument('--poi', help="POI layer (GeoPackage 'path|layername=name' or GeoParquet)")
+    parser.add_argument('--roads', required=True, help="walking/cycling road network layer")
+    parser.add_argument('--sap-bus', help="bus SAP layer")
+    parser.add_argument('--sap-trein', help="train SAP layer")
+    parser.add_argument('--baseline-relationships', help="baseline POI_SAP_Relationships table, to run a scenario in delta mode")
+    parser.add_argument('--scenario-sap', action='append', help="SAP layer with the new stops of a scenario, such as Lelylijn_sc1; repeat it to run several scenarios")
+    parser.add_argument('--output', required=True, help="output PTAL layer, or the output folder of the rasters with --grid")
+    parser.add_argument('--relationships', help="optional output for the POI_SAP_Relationships table")
+    parser.add_argument('--compact-relationships', action='store_true', help="write the relationships without POI geometry and with only the SAP fields PTAL needs")
+    parser.add_argument('--batch-size', type=int, default=50_000, help="rows per batch when streaming the relationships or PTAL rows")
+    parser.add_argument('--stream', action='store_true', help="compute PTAL in one streaming pass from distances to AI, without a relationships table")
+    parser.add_argument('--grid', type=float, metavar='CELL_SIZE', help="compute PTAL for the cells of a grid with this cell size instead of for POIs, written as .npy rasters")
+    parser.add_argument('--grid-extent', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'), help="extent of the grid, by default the bounds of the road network")
+    parser.add_argument('--grid-max-snap', type=float, metavar='DISTANCE', help="cells whose centre is further than this from the road network are nodata (NaN), by default half the diagonal of a cell")
+    parser.add_argument('--mode', choices=[POI_CENTRIC, SAP_CENTRIC], help="search from every POI or from every SAP (default poi, sap with --grid)")
+    parser.add_argument('--workers', type=int, default=1, help="number of worker processes")
+    parser.add_argument('--distance-cache', help="SQLite file to reuse network distances between runs")
+    args = parser.parse_args(argv)
+    if args.mode is None:
+        args.mode = SAP_CENTRIC if args.grid else POI_CENTRIC
+
+    if args.grid:
+        # Grid mode: every cell centre is scored like a POI, tile by tile into memory-mapped rasters
+        if not (args.sap_bus and args.sap_trein) or args.relationships or args.scenario_sap or args.stream:
+            parser.error("--grid needs --sap-bus and --sap-trein and cannot write --relationships, run scenarios or --stream")
+        rows, columns = grid_pipeline(read_layer(args.roads), read_layer(args.sap_bus), read_layer(args.sap_trein), args.output, args.grid, args.grid_extent, args.mode, args.workers, args.grid_max_snap)
+        print(f"PTAL rasters written to {args.output} for {rows} x {columns} cells.")
+        return
+    if not args.poi:
+        parser.error("--poi is required without --grid")
+
+    poi = read_layer(args.poi)
+    if args.stream:
+        # Fused mode: no relationships table is built, PTAL rows are written as their tiles finish
+        if not (args.sap_bus and args.sap_trein) or args.relationships or args.scenario_sap:
+            parser.error("--stream needs --sap-bus and --sap-trein and cannot write --relationships or run scenarios")
+        count = stream_pipeline(poi, read_layer(args.roads), read_layer(args.sap_bus), read_layer(args.sap_trein), args.output, args.mode, args.workers, args.distance_cache, args.batch_size)
+        print(f"PTAL layer written to {args.output} for {count} POIs.")
+        return
+
+    if bool(args.baseline_relationships) != bool(args.scenario_sap):
+        parser.error("--baseline-relationships and --scenario-sap go together, give both to run scenarios in delta mode")
+    if args.baseline_relationships and args.scenario_sap:
+        # Delta mode: only recompute POIs near the new stops of each scenario and merge them into the baseline
+        scenario_saps = {_scenario_name(source): read_layer(source) for source in args.scenario_sap}
+        relationships, ptal = run_scenarios(poi, read_layer(args.roads), read_relationships(args.baseline_relationships), scenario_saps, args.mode, args.workers, args.distance_cache)
+        if args.relationships:
+            if args.compact_relationships:
+                write_layer(relationships[['POI_ID', 'Distance', *COMPACT_SAP_FIELDS, *ANALYSIS_FIELDS, 'scenario']], args.relationships)
+            else:
+                write_layer(gpd.GeoDataFrame(relationships, geometry=poi.geometry.loc[relationships['POI_ID']].to_numpy(), crs=poi.crs), args.relationships)
+    elif args.sap_bus and args.sap_trein:
+        # Stream the relationships to their output in batches while they are computed
+        sink = None
+        if args.relationships:
+            sink = FileSink(args.relationships, None if args.compact_relationships else poi.geometry, COMPACT_SAP_FIELDS if args.compact_relationships else None)
+        relationships, ptal = run_pipeline(poi, read_layer(args.roads), read_layer(args.sap_bus), read_layer(args.sap_trein), args.mode, args.workers, args.distance_cache, sink, args.batch_size)
+        if sink is not None:
+            sink.close()
+    else:
+        parser.error("give --sap-bus and --sap-trein, or --baseline-relationships and --scenario-sap")
+
+    write_layer(ptal, args.output)
+    print(f"PTAL layer written to {args.output} for {len(ptal)} POIs.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import multiprocessing
+
+import numpy as np
+
+from distance_cache import DistanceCache
+from ptal_calc import assign_transport_mode_and_time_columns, calculate_ai_columns
+from relationships import POI_CENTRIC, SAP_CENTRIC, init_worker, poi_tiles, relationships_from_pois, relationships_from_saps, saps_in_halo, worker_state
+
+
+def ptal_for_pois(road_graph, pois, sap_layers, mode=POI_CENTRIC, distance_cache=None):
+    """Return (poi_id, ai_bus, ai_trein, ptai) rows for pois, straight from their network distances.
+
+    sap_layers is a list of (saps, sap_values, max_distance): saps are (id, x, y)
+    rows and sap_values maps SAP ids to (route_type, frequency). The relationship
+    rows only live until their EDF is added to the AI of their POI.
+    """
+    pois = list(pois)
+    poi_ids = []
+    route_types = []
+    distances = []
+    frequencies = []
+    for saps, sap_values, max_distance in sap_layers:
+        if mode == SAP_CENTRIC:
+            rows = relationships_from_saps(road_graph, pois, saps, max_distance)
+        else:
+            rows = relationships_from_pois(road_graph, pois, saps, max_distance, distance_cache=distance_cache)
+        for poi_id, sap_id, distance in rows:
+            route_type, frequency = sap_values[sap_id]
+            poi_ids.append(poi_id)
+            route_types.append(route_type)
+            distances.append(distance)
+            frequencies.append(frequency)
+
+    edf_values = assign_transport_mode_and_time_columns(route_types, distances, frequencies)['EDF']
+    ids = [poi_id for poi_id, _, _ in pois]
+    ai_bus, ai_trein = calculate_ai_columns(ids, poi_ids, route_types, edf_values)
+    return list(zip(ids, ai_bus.tolist(), ai_trein.tolist(), (ai_bus + ai_trein).tolist()))
+
+
+def _tile_ptal(tile):
+    pois, sap_layers, mode = tile
+    road_graph, distance_cache = worker_state()
+    return ptal_for_pois(road_graph, pois, sap_layers, mode, distance_cache)
+
+
+def stream_ptal(road_graph, pois, sap_layers, mode=POI_CENTRIC, workers=1, tile_size=5000.0, progress=None, cache_path=None):
+    """Yield (poi_id, ai_bus, ai_trein, ptai) rows tile by tile, without a relationships table.
+
+    Every tile holds the POIs of one tile_size square and, per SAP layer, the
+    SAPs in a halo of that layer's max_distance, so the PTAL rows of a tile are
+    final as soon as it is done. With workers > 1 tiles run in a process pool and
+    are still yielded in tile order. progress is called with the number of POIs
+    of every finished tile.
+    """
+    pois = list(pois)
+    sap_layers = [(list(saps), sap_values, max_distance) for saps, sap_values, max_distance in sap_layers]
+    sap_coords = [np.array([(x, y) for _, x, y in saps], dtype=np.float64).reshape(-1, 2) for saps, _, _ in sap_layers]
+
+    def tiles():
+        for tile, tile_pois in poi_tiles(pois, tile_size):
+            tile_layers = []
+            for (saps, sap_values, max_distance), coords in zip(sap_layers, sap_coords):
+                halo = [saps[k] for k in saps_in_halo(coords, tile, tile_size, max_distance)]
+                tile_layers.append((halo, {sap_id: sap_values[sap_id] for sap_id, _, _ in halo}, max_distance))
+            yield tile_pois, tile_layers, mode
+
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(road_graph, cache_path)) as pool:
+            for rows in pool.imap(_tile_ptal, tiles()):
+                yield from rows
+                if progress is not None:
+                    progress(len(rows))
+    else:
+        distance_cache = DistanceCache(cache_path, road_graph.network_hash) if cache_path else None
+        for tile_pois, tile_layers, _ in tiles():
+            yield from ptal_for_pois(road_graph, tile_pois, tile_layers, mode, distance_cache)
+            if progress is not None:
+                progress(len(tile_pois))
+        if distance_cache:
+            distance_cache.close()
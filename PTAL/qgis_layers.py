@@ -0,0 +1,49 @@
+from qgis.core import QgsFeature, QgsWkbTypes
+
+from road_graph import RoadGraph
+
+# Road graphs built during this QGIS session, keyed by layer source and feature count
+_road_graphs = {}
+
+
+# Yield the vertices of every line part in a layer as lists of (x, y) tuples
+def layer_polylines(layer):
+    for feature in layer.getFeatures():
+        geometry = feature.geometry()
+        if geometry.isEmpty() or geometry.type() != QgsWkbTypes.LineGeometry:
+            continue
+        if geometry.isMultipart():
+            parts = geometry.asMultiPolyline()
+        else:
+            parts = [geometry.asPolyline()]
+        for part in parts:
+            yield [(point.x(), point.y()) for point in part]
+
+
+# Return the road graph of a line layer, building it only the first time it is asked for
+def road_graph_for_layer(layer):
+    key = (layer.source(), layer.featureCount())
+    if key not in _road_graphs:
+        _road_graphs[key] = RoadGraph(layer_polylines(layer))
+    return _road_graphs[key]
+
+
+# Writes batches of relationship rows to a layer with one addFeatures call per batch,
+# sap_attributes maps SAP ids to the attributes that follow POI_ID and Distance
+class LayerSink:
+    def __init__(self, layer, poi_geometries=None):
+        self.layer = layer
+        self.provider = layer.dataProvider()
+        # Without POI geometries the rows are added as attributes only, for tables without geometry
+        self.poi_geometries = poi_geometries
+
+    def write(self, poi_ids, sap_ids, distances, sap_attributes):
+        fields = self.layer.fields()
+        features = []
+        for poi_id, sap_id, distance in zip(poi_ids, sap_ids, distances):
+            feature = QgsFeature(fields)
+            if self.poi_geometries is not None:
+                feature.setGeometry(self.poi_geometries[poi_id])
+            feature.setAttributes([poi_id, distance] + sap_attributes[sap_id])
+            features.append(feature)
+        self.provider.addFeatures(features)
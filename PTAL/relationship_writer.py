@@ -0,0 +1,126 @@
+import json
+from array import array
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+
+# The SAP fields PTAL_analysis and PTAL_score read, enough for compact relationship rows
+COMPACT_SAP_FIELDS = ['route_type', 'frequency']
+
+# Name of the SAP fid in the relationship rows, a GeoPackage output keeps fid for its own feature ids
+SAP_FID_FIELD = 'sap_fid'
+
+
+def relationship_field_name(sap_field_name):
+    """Name of a SAP field in the relationship rows: fid becomes SAP_FID_FIELD, other fields keep their name."""
+    return SAP_FID_FIELD if sap_field_name == 'fid' else sap_field_name
+
+
+class RelationshipBuffer:
+    """Collects (poi_id, sap_id, distance) rows in columns and hands them to a sink in batches.
+
+    A sink has a write(poi_ids, sap_ids, distances, sap_attributes) method that
+    writes one batch; sap_attributes is whatever lookup the sink uses to turn
+    SAP ids into attributes. Replaces adding and committing features per POI.
+    """
+
+    def __init__(self, sink, sap_attributes, batch_size=50_000):
+        self.sink = sink
+        self.sap_attributes = sap_attributes
+        self.batch_size = batch_size
+        self.rows = 0
+        self._clear()
+
+    def _clear(self):
+        self.poi_ids = []
+        self.sap_ids = []
+        self.distances = array('d')
+
+    def add(self, poi_id, sap_id, distance):
+        self.poi_ids.append(poi_id)
+        self.sap_ids.append(sap_id)
+        self.distances.append(distance)
+        if len(self.distances) >= self.batch_size:
+            self.flush()
+
+    def extend(self, rows):
+        for poi_id, sap_id, distance in rows:
+            self.add(poi_id, sap_id, distance)
+
+    def flush(self):
+        if self.distances:
+            self.sink.write(self.poi_ids, self.sap_ids, self.distances, self.sap_attributes)
+            self.rows += len(self.distances)
+            self._clear()
+
+
+class FrameWriter:
+    """Appends DataFrames or GeoDataFrames to a GeoPackage layer or a Parquet file, batch by batch."""
+
+    def __init__(self, source):
+        path, _, options = str(source).partition('|')
+        self.path = path
+        self.layer = options.split('=', 1)[1] if options.startswith('layername=') else None
+        self.writer = None
+        self.appending = False
+
+    def write_frame(self, frame):
+        if self.path.endswith('.parquet'):
+            # One row group per batch, the schema is fixed by the first batch
+            table = pa.Table.from_pandas(frame.to_wkb() if isinstance(frame, gpd.GeoDataFrame) else frame, preserve_index=False)
+            if self.writer is None:
+                schema = table.schema
+                if isinstance(frame, gpd.GeoDataFrame):
+                    schema = schema.with_metadata({**(schema.metadata or {}), b'geo': _geo_metadata(frame)})
+                self.writer = pq.ParquetWriter(self.path, schema)
+            self.writer.write_table(table.cast(self.writer.schema))
+        else:
+            pyogrio.write_dataframe(frame, self.path, layer=self.layer, driver='GPKG', append=self.appending)
+            self.appending = True
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class FileSink(FrameWriter):
+    """Streams relationship batches to a GeoPackage layer or a Parquet file.
+
+    sap_attributes of the buffers must come from sap_attribute_table. With
+    poi_geometries (a GeoSeries indexed by POI id) every row gets the POI point,
+    without it the rows are a plain table. sap_fields selects the SAP columns,
+    by default those of the first batch; use COMPACT_SAP_FIELDS for compact rows.
+    """
+
+    def __init__(self, source, poi_geometries=None, sap_fields=None):
+        super().__init__(source)
+        self.poi_geometries = poi_geometries
+        self.sap_fields = sap_fields
+
+    def write(self, poi_ids, sap_ids, distances, sap_attributes):
+        if self.sap_fields is None:
+            self.sap_fields = list(sap_attributes.columns)
+        attributes = sap_attributes.reindex(columns=self.sap_fields).loc[list(sap_ids)].reset_index(drop=True)
+        frame = pd.concat([pd.DataFrame({'POI_ID': poi_ids, 'Distance': distances}), attributes], axis=1)
+        if self.poi_geometries is not None:
+            frame = gpd.GeoDataFrame(frame, geometry=self.poi_geometries.loc[list(poi_ids)].to_numpy(), crs=self.poi_geometries.crs)
+        self.write_frame(frame)
+
+
+def _geo_metadata(frame):
+    # GeoParquet metadata for the WKB geometry column, so gpd.read_parquet reads the rows back as points
+    return json.dumps({
+        'version': '1.0.0',
+        'primary_column': frame.geometry.name,
+        'columns': {frame.geometry.name: {'encoding': 'WKB', 'geometry_types': ['Point'], 'crs': frame.crs.to_json_dict() if frame.crs else None}},
+    })
+
+
+def sap_attribute_table(sap):
+    """Attributes of a SAP GeoDataFrame for FileSink: its fid, as SAP_FID_FIELD, and fields without geometry, indexed by SAP id."""
+    attributes = pd.DataFrame(sap.drop(columns=sap.geometry.name)).reset_index(names=SAP_FID_FIELD)
+    return attributes.set_index(sap.index)
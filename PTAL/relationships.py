@@ -0,0 +1,188 @@
+import math
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+
+from candidate_index import CandidateIndex
+from distance_cache import DistanceCache, snap_key
+
+# SAPs further than this from the road network are not reachable (same as the old join MAX_DISTANCE)
+SAP_MAX_SNAP_DISTANCE = 1
+
+# Ways to compute the POI-SAP relationships: one search per POI or one search per SAP
+POI_CENTRIC = 'poi'
+SAP_CENTRIC = 'sap'
+
+# Number of POIs between writes to the distance cache
+CACHE_FLUSH_INTERVAL = 1000
+
+
+def relationships_from_pois(road_graph, pois, saps, max_distance, progress=None, distance_cache=None):
+    """Find every SAP within max_distance of each POI with one search per POI.
+
+    pois and saps are iterables of (id, x, y). Yields (poi_id, sap_id, distance) rows.
+    With a DistanceCache, POIs whose candidate SAPs are all cached skip the search.
+    """
+    # Snap the points that are not cached yet in one batch and index the SAPs for candidate lookups
+    pois = list(pois)
+    saps = list(saps)
+    road_graph.snap_many([(x, y) for _, x, y in pois + saps if (x, y) not in road_graph.snap_cache])
+    sap_coords = {sap_id: (x, y) for sap_id, x, y in saps}
+    sap_index = CandidateIndex.from_points(list(sap_coords), list(sap_coords.values()))
+
+    for count, (poi_id, x, y) in enumerate(pois, 1):
+        source = road_graph.snap(x, y)
+        if source is not None:
+            # Only SAPs within the straight-line radius can be within reach along the network
+            candidates = []
+            for sap_id in sap_index.within(x, y, max_distance):
+                target = road_graph.snap(*sap_coords[sap_id], SAP_MAX_SNAP_DISTANCE)
+                if target is not None:
+                    candidates.append((sap_id, snap_key(target), target))
+
+            # Search the network unless every candidate distance is cached
+            poi_key = snap_key(source)
+            distances = distance_cache.lookup(poi_key, [key for _, key, _ in candidates], max_distance) if distance_cache else {}
+            if any(key not in distances for _, key, _ in candidates):
+                node_distances = road_graph.distances_from(source, max_distance)
+                for _, key, target in candidates:
+                    distance = road_graph.distance_to(source, node_distances, target)
+                    distances[key] = distance if distance is not None and distance <= max_distance else None
+                if distance_cache:
+                    distance_cache.store(poi_key, distances, max_distance)
+
+            for sap_id, key, _ in candidates:
+                if distances[key] is not None:
+                    yield poi_id, sap_id, distances[key]
+
+        if distance_cache and count % CACHE_FLUSH_INTERVAL == 0:
+            distance_cache.flush()
+        if progress is not None:
+            progress()
+
+    if distance_cache:
+        distance_cache.flush()
+
+
+def relationships_from_saps(road_graph, pois, saps, max_distance, progress=None):
+    """Find every POI within max_distance of each SAP with one search per SAP.
+
+    pois and saps are iterables of (id, x, y). Yields (poi_id, sap_id, distance)
+    rows, the same pairs the POI-centric search produces.
+    """
+    # Snap the points that are not cached yet in one batch and group the POIs by the edge they lie on
+    pois = list(pois)
+    saps = list(saps)
+    road_graph.snap_many([(x, y) for _, x, y in pois + saps if (x, y) not in road_graph.snap_cache])
+    pois_by_edge = defaultdict(list)
+    for poi_id, x, y in pois:
+        snap = road_graph.snap(x, y)
+        if snap is not None:
+            pois_by_edge[snap.edge].append((poi_id, x, y, snap))
+
+    for sap_id, x, y in saps:
+        source = road_graph.snap(x, y, SAP_MAX_SNAP_DISTANCE)
+        if source is not None:
+            node_distances = road_graph.distances_from(source, max_distance)
+
+            # Only POIs on edges the search touched can be within reach, and like the
+            # POI-centric search only SAPs within the straight-line radius count
+            for edge in road_graph.reached_edges(source, node_distances):
+                for poi_id, poi_x, poi_y, target in pois_by_edge.get(edge, ()):
+                    if math.hypot(poi_x - x, poi_y - y) > max_distance:
+                        continue
+                    distance = road_graph.distance_to(source, node_distances, target)
+                    if distance is not None and distance <= max_distance:
+                        yield poi_id, sap_id, distance
+
+        if progress is not None:
+            progress()
+
+
+# Road graph and distance cache of a worker process, set once by the pool initializer
+_worker_graph = None
+_worker_cache = None
+
+
+def init_worker(road_graph, cache_path=None):
+    """Pool initializer that gives a worker process the road graph and, with cache_path, a DistanceCache."""
+    global _worker_graph, _worker_cache
+    _worker_graph = road_graph
+    _worker_cache = DistanceCache(cache_path, road_graph.network_hash) if cache_path else None
+
+
+def worker_state():
+    """Return the (road_graph, distance_cache) that init_worker set in this worker process."""
+    return _worker_graph, _worker_cache
+
+
+def _tile_relationships(tile):
+    pois, saps, max_distance, mode = tile
+    if mode == SAP_CENTRIC:
+        return list(relationships_from_saps(_worker_graph, pois, saps, max_distance))
+    return list(relationships_from_pois(_worker_graph, pois, saps, max_distance, distance_cache=_worker_cache))
+
+
+def poi_tiles(pois, tile_size):
+    """Group (id, x, y) POIs by tile_size square, returns ((i, j), POIs) pairs in tile order."""
+    tile_pois = defaultdict(list)
+    for poi in pois:
+        tile_pois[(math.floor(poi[1] / tile_size), math.floor(poi[2] / tile_size))].append(poi)
+    return [(tile, tile_pois[tile]) for tile in sorted(tile_pois)]
+
+
+def saps_in_halo(sap_coords, tile, tile_size, max_distance):
+    """Return the indexes of the SAP coordinates within a halo of max_distance around a tile."""
+    i, j = tile
+    xmin, ymin = i * tile_size - max_distance, j * tile_size - max_distance
+    xmax, ymax = (i + 1) * tile_size + max_distance, (j + 1) * tile_size + max_distance
+    return np.flatnonzero((sap_coords[:, 0] >= xmin) & (sap_coords[:, 0] <= xmax) & (sap_coords[:, 1] >= ymin) & (sap_coords[:, 1] <= ymax))
+
+
+def relationships_by_tile(road_graph, pois, saps, max_distance, mode=POI_CENTRIC, workers=1, tile_size=5000.0, cache_path=None):
+    """Compute the relationships on spatial tiles of POIs, yields (tile POIs, rows) for every tile in tile order.
+
+    Each tile holds the POIs of one tile_size square and the SAPs within a halo
+    of max_distance around it, so tiles can be processed independently; with
+    workers > 1 they run in a process pool. Every tile is complete when it is
+    yielded, which makes it the unit to checkpoint. With cache_path the searches
+    read and write the distance cache in that SQLite file.
+    """
+    pois = list(pois)
+    saps = list(saps)
+    sap_coords = np.array([(x, y) for _, x, y in saps], dtype=np.float64).reshape(-1, 2)
+
+    # Group the POIs by tile and give every tile the SAPs in its halo
+    tiles = []
+    for tile, tile_pois in poi_tiles(pois, tile_size):
+        tiles.append((tile_pois, [saps[k] for k in saps_in_halo(sap_coords, tile, tile_size, max_distance)], max_distance, mode))
+
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(road_graph, cache_path)) as pool:
+            yield from zip((tile[0] for tile in tiles), pool.imap(_tile_relationships, tiles))
+        return
+
+    distance_cache = DistanceCache(cache_path, road_graph.network_hash) if cache_path else None
+    for tile_pois, tile_saps, _, _ in tiles:
+        if mode == SAP_CENTRIC:
+            rows = relationships_from_saps(road_graph, tile_pois, tile_saps, max_distance)
+        else:
+            rows = relationships_from_pois(road_graph, tile_pois, tile_saps, max_distance, distance_cache=distance_cache)
+        yield tile_pois, list(rows)
+    if distance_cache:
+        distance_cache.close()
+
+
+def relationships_in_parallel(road_graph, pois, saps, max_distance, mode=POI_CENTRIC, workers=None, tile_size=5000.0, progress=None, cache_path=None):
+    """Compute the relationships on spatial tiles of POIs in a process pool.
+
+    Rows are yielded in tile order, whatever order the workers finish in, and
+    progress is called with the number of POIs of every finished tile. With
+    cache_path every worker reads and writes the distance cache in that SQLite
+    file.
+    """
+    for tile_pois, rows in relationships_by_tile(road_graph, pois, saps, max_distance, mode, workers or multiprocessing.cpu_count(), tile_size, cache_path):
+        yield from rows
+        if progress is not None:
+            progress(len(tile_pois))
@@ -0,0 +1,191 @@
+import hashlib
+import heapq
+import math
+from collections import namedtuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Location of a point on the network: the edge it snaps to, the fraction along
+# that edge (0 at the first node, 1 at the second) and the distance to the edge
+Snap = namedtuple('Snap', ['edge', 't', 'offset'])
+
+
+class RoadGraph:
+    """Undirected walking/cycling network with one node per line vertex.
+
+    Vertices are matched on their exact coordinates, like the QGIS network tools
+    with a topology tolerance of 0, and every edge costs its length in map units.
+    The adjacency is kept in compact CSR arrays and points are snapped to the
+    nearest edge through a KD-tree of points sampled along the edges.
+    """
+
+    def __init__(self, polylines, sample_spacing=50.0):
+        # Flatten all line parts, remembering where each part starts
+        coords = []
+        part_starts = []
+        for polyline in polylines:
+            if len(polyline):
+                part_starts.append(len(coords))
+                coords.extend(polyline)
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        is_start = np.zeros(len(coords), dtype=bool)
+        is_start[part_starts] = True
+
+        # Merge vertices with identical coordinates into nodes
+        self.node_coords, inverse = np.unique(coords, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        # Every pair of consecutive vertices in a part is an edge
+        follows = np.flatnonzero(~is_start[1:]) + 1
+        edge_u = inverse[follows - 1]
+        edge_v = inverse[follows]
+        keep = edge_u != edge_v
+        self.edge_u = edge_u[keep].astype(np.int32)
+        self.edge_v = edge_v[keep].astype(np.int32)
+        delta = self.node_coords[self.edge_v] - self.node_coords[self.edge_u]
+        self.edge_lengths = np.hypot(delta[:, 0], delta[:, 1])
+
+        # CSR adjacency holding both directions of every edge
+        edge_ids = np.arange(len(self.edge_u), dtype=np.int32)
+        sources = np.concatenate([self.edge_u, self.edge_v])
+        order = np.argsort(sources, kind='stable')
+        self.indptr = np.zeros(len(self.node_coords) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self.node_coords)), out=self.indptr[1:])
+        self.indices = np.concatenate([self.edge_v, self.edge_u])[order]
+        self.weights = np.concatenate([self.edge_lengths, self.edge_lengths])[order]
+        self.adjacent_edges = np.concatenate([edge_ids, edge_ids])[order]
+
+        # Sample points along the edges, no further apart than sample_spacing
+        self.sample_spacing = sample_spacing
+        steps = np.maximum(np.ceil(self.edge_lengths / sample_spacing), 1).astype(np.int64)
+        self.sample_edges = np.repeat(edge_ids, steps + 1)
+        first_sample = np.repeat(np.cumsum(steps + 1) - (steps + 1), steps + 1)
+        fractions = (np.arange(len(self.sample_edges)) - first_sample) / np.repeat(steps, steps + 1)
+        samples = self.node_coords[self.edge_u][self.sample_edges] + fractions[:, None] * delta[self.sample_edges]
+        self.sample_tree = cKDTree(samples)
+
+        # Identifies this version of the network, for example in the distance cache
+        digest = hashlib.sha1()
+        for array in (self.node_coords, self.edge_u, self.edge_v):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        self.network_hash = digest.hexdigest()
+
+        # Snap results by point coordinates, reused by every later search
+        self.snap_cache = {}
+        self._make_views()
+
+    def _make_views(self):
+        # Views on the arrays that give fast scalar access in the search loops
+        self._indptr = memoryview(self.indptr)
+        self._indices = memoryview(self.indices)
+        self._weights = memoryview(self.weights)
+        self._adjacent_edges = memoryview(self.adjacent_edges)
+        self._edge_u = memoryview(self.edge_u)
+        self._edge_v = memoryview(self.edge_v)
+        self._edge_lengths = memoryview(self.edge_lengths)
+
+    def __getstate__(self):
+        # Memoryviews cannot be pickled, they are rebuilt when the graph is sent to a worker process
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def snap_many(self, points):
+        """Snap an (n, 2) array of points to their nearest edges in one batched query.
+
+        Returns the edge, fraction and offset arrays and stores every result in the snap cache.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        edges = np.full(len(points), -1, dtype=np.int64)
+        fractions = np.zeros(len(points))
+        offsets = np.full(len(points), np.inf)
+        if len(points) == 0 or len(self.edge_u) == 0:
+            self.snap_cache.update((key, None) for key in map(tuple, points.tolist()))
+            return edges, fractions, offsets
+
+        # The nearest edge has a sample within half a spacing of the nearest sample distance
+        nearest, _ = self.sample_tree.query(points)
+        candidates = self.sample_tree.query_ball_point(points, nearest + self.sample_spacing / 2)
+        counts = np.fromiter((len(c) for c in candidates), dtype=np.int64, count=len(points))
+        point_ids = np.repeat(np.arange(len(points)), counts)
+        candidate_edges = self.sample_edges[np.concatenate(candidates).astype(np.int64)]
+
+        # Project each point on its candidate edges and keep the closest one
+        start = self.node_coords[self.edge_u[candidate_edges]]
+        delta = self.node_coords[self.edge_v[candidate_edges]] - start
+        relative = points[point_ids] - start
+        t = np.clip((relative * delta).sum(axis=1) / (delta * delta).sum(axis=1), 0.0, 1.0)
+        distance = np.hypot(*(relative - t[:, None] * delta).T)
+        order = np.lexsort((distance, point_ids))
+        best = order[np.r_[True, point_ids[order][1:] != point_ids[order][:-1]]]
+
+        edges[point_ids[best]] = candidate_edges[best]
+        fractions[point_ids[best]] = t[best]
+        offsets[point_ids[best]] = distance[best]
+        for (x, y), edge, fraction, offset in zip(points.tolist(), edges.tolist(), fractions.tolist(), offsets.tolist()):
+            self.snap_cache[(x, y)] = Snap(edge, fraction, offset) if edge >= 0 else None
+        return edges, fractions, offsets
+
+    def snap(self, x, y, max_offset=math.inf):
+        """Return the Snap of (x, y) on the nearest edge, or None if there is none within max_offset."""
+        key = (float(x), float(y))
+        if key not in self.snap_cache:
+            self.snap_many([key])
+        snap = self.snap_cache[key]
+        if snap is None or snap.offset > max_offset:
+            return None
+        return snap
+
+    def _seeds(self, snap):
+        length = self._edge_lengths[snap.edge]
+        return ((self._edge_u[snap.edge], snap.t * length), (self._edge_v[snap.edge], (1 - snap.t) * length))
+
+    def distances_from(self, source, max_distance):
+        """Run a Dijkstra search from a Snap that stops at max_distance.
+
+        Returns a dict with the network distance of every node that was reached.
+        """
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        distances = {}
+        heap = []
+        for node, cost in self._seeds(source):
+            if cost <= max_distance and cost < distances.get(node, math.inf):
+                distances[node] = cost
+                heapq.heappush(heap, (cost, node))
+
+        settled = set()
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            for k in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[k]
+                new_cost = cost + weights[k]
+                if new_cost <= max_distance and new_cost < distances.get(neighbour, math.inf):
+                    distances[neighbour] = new_cost
+                    heapq.heappush(heap, (new_cost, neighbour))
+
+        return distances
+
+    def distance_to(self, source, distances, target):
+        """Return the network distance from source to target Snap using a finished search, or None."""
+        length = self._edge_lengths[target.edge]
+        best = math.inf
+        if source.edge == target.edge:
+            best = abs(source.t - target.t) * length
+        for node, cost in self._seeds(target):
+            if node in distances:
+                best = min(best, distances[node] + cost)
+        return best if best < math.inf else None
+
+    def reached_edges(self, source, distances):
+        """Return the ids of all edges touched by a finished search, including the source edge."""
+        indptr, adjacent_edges = self._indptr, self._adjacent_edges
+        edges = {source.edge}
+        for node in distances:
+            edges.update(adjacent_edges[indptr[node]:indptr[node + 1]])
+        return edges
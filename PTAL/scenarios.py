@@ -0,0 +1,60 @@
+import numpy as np
+
+from candidate_index import CandidateIndex
+from distance_cache import DistanceCache
+from relationships import POI_CENTRIC, SAP_CENTRIC, relationships_from_pois, relationships_from_saps, relationships_in_parallel
+
+
+class ScenarioRunner:
+    """Runs scenarios of new stops against state that is shared between them.
+
+    The POIs are snapped to the road graph and put in a spatial index once, so
+    every scenario only pays for the searches around its own new stops. With a
+    cache_path the network distances are also kept in an on-disk DistanceCache.
+    """
+
+    def __init__(self, road_graph, pois, cache_path=None):
+        self.road_graph = road_graph
+        self.cache_path = cache_path
+        self.distance_cache = DistanceCache(cache_path, road_graph.network_hash) if cache_path and road_graph is not None else None
+        self.pois = list(pois)
+        coords = [(x, y) for _, x, y in self.pois]
+        if road_graph is not None:
+            road_graph.snap_many([point for point in coords if point not in road_graph.snap_cache])
+        self.poi_index = CandidateIndex.from_points(np.arange(len(self.pois)), coords)
+
+    def affected_pois(self, new_saps, max_distance):
+        """Return the POIs within max_distance in a straight line of any new SAP, in input order.
+
+        new_saps is an iterable of (id, x, y). Only these POIs can gain
+        relationships when the new stops are added to the baseline.
+        """
+        new_saps = list(new_saps)
+        if not self.pois or not new_saps:
+            return []
+        _, found = self.poi_index.within_many([(x, y) for _, x, y in new_saps], max_distance)
+        return [self.pois[k] for k in np.unique(found).tolist()]
+
+    def relationships(self, new_saps, max_distance, mode=POI_CENTRIC, workers=1, progress=None, delta=True, pois=None):
+        """Return an iterator over the (poi_id, sap_id, distance) rows between the new SAPs and the affected POIs.
+
+        With delta=False all POIs are searched, for scenarios that are not merged into a baseline.
+        Callers that already selected the POIs (e.g. to size progress reporting) pass them as pois.
+        """
+        new_saps = list(new_saps)
+        if pois is None:
+            pois = self.affected_pois(new_saps, max_distance) if delta else self.pois
+        if workers > 1:
+            return relationships_in_parallel(self.road_graph, pois, new_saps, max_distance, mode, workers, progress=progress, cache_path=self.cache_path)
+        if mode == SAP_CENTRIC:
+            return relationships_from_saps(self.road_graph, pois, new_saps, max_distance, progress)
+        return relationships_from_pois(self.road_graph, pois, new_saps, max_distance, progress, self.distance_cache)
+
+    def close(self):
+        if self.distance_cache:
+            self.distance_cache.close()
+
+
+def affected_pois(pois, new_saps, max_distance):
+    """Return the POIs within max_distance in a straight line of any new SAP, in input order."""
+    return ScenarioRunner(None, pois).affected_pois(new_saps, max_distance)
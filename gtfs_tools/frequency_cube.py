@@ -0,0 +1,169 @@
+"""Departures per stop, route direction, service date and hour, counted in one pass over stop_times.
+
+The counts are one array of day patterns x hours x stop lines. A stop line is a
+stop together with a route direction (route_id and trip_headsign) that serves
+it; only the stop lines that occur are stored, as a full stop x route direction
+grid would be almost all zeros. Dates with the same services share one day
+pattern. The departures of any period, such as the PTAL evening peak, an
+off-peak hour or a weekend, are then a slice of the memory-mapped array.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+from gtfs_cache import CACHE_DIR, cache_feed, read_cached_feed
+
+# A route direction: the trips of a route with the same headsign
+LINE_COLUMNS = ['route_id', 'trip_headsign']
+
+# Attributes of the route directions, from routes.txt
+ROUTE_COLUMNS = ['route_short_name', 'route_long_name', 'route_type', 'agency_id']
+
+
+def _positions(values, index):
+    # Position of every value in index (-1 when missing), categoricals are looked up per category
+    index = pd.Index(np.asarray(index).astype(str))
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        positions = index.get_indexer(values.cat.categories.astype(str))
+        return np.where(codes >= 0, positions[codes], -1)
+    return index.get_indexer(np.asarray(values).astype(str))
+
+
+def _day_patterns(calendar_dates, services):
+    # The service dates, and per date the index of its set of services
+    added = calendar_dates[calendar_dates['exception_type'] == 1]
+    days = pd.DataFrame({'date': added['date'].to_numpy(), 'service': _positions(added['service_id'], services)})
+    dates = []
+    day_patterns = []
+    patterns = {}
+    for date, day in days[days['service'] >= 0].groupby('date'):
+        pattern = frozenset(day['service'].tolist())
+        dates.append(date)
+        day_patterns.append(patterns.setdefault(pattern, len(patterns)))
+    return np.array(dates, dtype=np.int32), np.array(day_patterns, dtype=np.int32), list(patterns)
+
+
+def build_frequency_cube(path, calendar_dates, routes, trips, stop_times):
+    """Count the departures of stop_times per day pattern, hour and stop line and store them in the directory path.
+
+    The tables are GTFS tables as read by gtfs_loader or gtfs_cache, with the
+    departure times in seconds. The service dates are the dates on which
+    calendar_dates adds a service. Departures are counted in the hour they
+    leave, so 18:00:00 belongs to the 18:00-19:00 hour.
+    """
+    # The route direction and service of every trip
+    trip_line, lines = pd.MultiIndex.from_frame(trips[LINE_COLUMNS].astype(str)).factorize()
+    trip_service, services = pd.factorize(trips['service_id'].astype(str))
+
+    # The trip of every departure, departures without a known trip or time are left out
+    trip = _positions(stop_times['trip_id'], trips['trip_id'])
+    departure = stop_times['departure_time'].to_numpy()
+    keep = (trip >= 0) & (departure >= 0)
+    trip = trip[keep]
+    hour = departure[keep] // 3600
+    stop_codes, stop_ids = pd.factorize(stop_times['stop_id'].to_numpy()[keep])
+    # At least the 24 hours of a day, and the night hours past 24:00 that have departures
+    hours = max(int(hour.max()) + 1 if len(hour) else 0, 24)
+
+    # The stop lines that occur, and the departures per stop line, service and hour
+    pair_keys, pair = np.unique(stop_codes.astype(np.int64) * len(lines) + trip_line[trip], return_inverse=True)
+    keys, counts = np.unique((pair.astype(np.int64) * len(services) + trip_service[trip]) * hours + hour, return_counts=True)
+    key_hour = keys % hours
+    key_service = keys // hours % len(services)
+    key_pair = keys // hours // len(services)
+
+    # One slice of departures per day pattern, the sum over its services
+    dates, day_patterns, patterns = _day_patterns(calendar_dates, services)
+    os.makedirs(path, exist_ok=True)
+    departures = np.lib.format.open_memmap(os.path.join(path, 'departures.npy'), mode='w+', dtype=np.uint16, shape=(len(patterns), hours, len(pair_keys)))
+    for index, pattern in enumerate(patterns):
+        active = np.zeros(len(services), dtype=bool)
+        active[list(pattern)] = True
+        selected = active[key_service]
+        pattern_departures = np.bincount(key_hour[selected] * len(pair_keys) + key_pair[selected], weights=counts[selected], minlength=hours * len(pair_keys))
+        departures[index] = np.minimum(pattern_departures, np.iinfo(np.uint16).max).reshape(hours, len(pair_keys))
+    departures.flush()
+    del departures
+
+    # The route directions with the attributes of their route
+    line_table = lines.to_frame(index=False, name=LINE_COLUMNS)
+    route_table = routes.astype({'route_id': str})[['route_id'] + [column for column in ROUTE_COLUMNS if column in routes]]
+    line_table = line_table.merge(route_table.drop_duplicates('route_id'), on='route_id', how='left')
+    feather.write_feather(line_table, os.path.join(path, 'lines.arrow'), compression='uncompressed')
+
+    stop_ids = np.asarray(stop_ids)
+    np.save(os.path.join(path, 'stop_ids.npy'), stop_ids.astype(str) if stop_ids.dtype == object else stop_ids)
+    np.save(os.path.join(path, 'pair_stops.npy'), (pair_keys // len(lines)).astype(np.int32))
+    np.save(os.path.join(path, 'pair_lines.npy'), (pair_keys % len(lines)).astype(np.int32))
+    np.save(os.path.join(path, 'dates.npy'), dates)
+    np.save(os.path.join(path, 'day_patterns.npy'), day_patterns)
+    # Written last, a cube without meta.json is incomplete
+    with open(os.path.join(path, 'meta.json'), 'w') as meta:
+        json.dump({'hours': hours, 'patterns': len(patterns), 'stop_lines': len(pair_keys)}, meta)
+
+
+def frequency_cube(feed, cache_dir=CACHE_DIR):
+    """Return the FrequencyCube of a GTFS feed, stored with its cache in cache_dir and built on first use."""
+    path = os.path.join(cache_feed(feed, cache_dir), 'frequency_cube')
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        tables = read_cached_feed(
+            feed, tables=['calendar_dates', 'routes', 'trips', 'stop_times'],
+            columns={'trips': ['route_id', 'service_id', 'trip_id', 'trip_headsign'], 'stop_times': ['trip_id', 'stop_id', 'departure_time']},
+            cache_dir=cache_dir,
+        )
+        build_frequency_cube(path, **tables)
+    return FrequencyCube(path)
+
+
+class FrequencyCube:
+    """Memory-mapped departures from build_frequency_cube, the departures of a period are a slice of it."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as meta:
+            self.hours = json.load(meta)['hours']
+        self.departures = np.load(os.path.join(path, 'departures.npy'), mmap_mode='r')
+        self.stop_ids = np.load(os.path.join(path, 'stop_ids.npy'))
+        self.pair_stops = np.load(os.path.join(path, 'pair_stops.npy'))
+        self.pair_lines = np.load(os.path.join(path, 'pair_lines.npy'))
+        self.lines = feather.read_feather(os.path.join(path, 'lines.arrow'))
+        self.dates = np.load(os.path.join(path, 'dates.npy'))
+        self.day_patterns = np.load(os.path.join(path, 'day_patterns.npy'))
+        self.date_index = {date: index for index, date in enumerate(self.dates.tolist())}
+
+    def departures_in(self, dates, start_hour, end_hour):
+        """Return the departures of every stop line in the hours start_hour up to end_hour, summed over dates.
+
+        Dates are 'YYYY-MM-DD' or YYYYMMDD; hours past 24 are the night of the
+        service day, as in GTFS. The hours have to lie within the hours of the
+        cube, 0 up to self.hours, otherwise a ValueError is raised.
+        """
+        if not 0 <= start_hour < end_hour <= self.hours:
+            raise ValueError(f'hours {start_hour} up to {end_hour} are not within the 0 to {self.hours} hours of the cube')
+        patterns = []
+        for date in dates:
+            date = int(str(date).replace('-', ''))
+            if date not in self.date_index:
+                raise KeyError(f'{date} is not a service date of the feed')
+            patterns.append(self.day_patterns[self.date_index[date]])
+
+        # Dates with the same day pattern are counted once, weighted by their number
+        total = np.zeros(self.departures.shape[2], dtype=np.int64)
+        for pattern, count in zip(*np.unique(patterns, return_counts=True)):
+            total += count * self.departures[pattern, start_hour:end_hour].sum(axis=0, dtype=np.int64)
+        return total
+
+    def frequencies(self, dates, start_hour, end_hour):
+        """Return the departures per hour, averaged over the period, of every stop line that is served in it.
+
+        One row per stop and route direction, with the route attributes.
+        """
+        departures = self.departures_in(dates, start_hour, end_hour)
+        served = np.flatnonzero(departures)
+        frame = self.lines.iloc[self.pair_lines[served]].reset_index(drop=True)
+        frame.insert(0, 'stop_id', self.stop_ids[self.pair_stops[served]])
+        frame['frequency'] = departures[served] / (len(dates) * (end_hour - start_hour))
+        return frame
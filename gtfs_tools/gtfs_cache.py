@@ -0,0 +1,168 @@
+"""A columnar cache of GTFS feeds, shared by the PTAL and the travel time notebooks.
+
+The first time a feed is used its tables are read with gtfs_loader, normalized
+and written as uncompressed Arrow (Feather) files in a directory named after the
+hash of the feed; the hash is only computed again when the size or modification
+time of the feed changes. Later runs memory-map those files and only turn the
+rows they keep into DataFrames, so another date or time window does not parse
+the text files again. In the cache stop ids are integers, without the stop areas
+and duplicate stops whose id is not a number, and times are int32 seconds after
+the start of the service day.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+from gtfs_loader import TABLES, TIME_COLUMNS, format_times, read_feed, service_ids_on, time_bound
+
+# Cache directory in the root of the repository, next to the feed zip
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gtfs_cache')
+
+# Part of the cache key, raise it when the normalized tables change
+CACHE_VERSION = 1
+
+# Bytes hashed at once
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def _feed_paths(feed):
+    # The feed zip, or the table files of a feed folder
+    if os.path.isdir(feed):
+        return [os.path.join(feed, f'{name}.txt') for name in TABLES]
+    return [feed]
+
+
+def feed_hash(feed):
+    """SHA-256 of the feed zip, or of the tables of a feed folder."""
+    digest = hashlib.sha256(f'gtfs-cache-{CACHE_VERSION}'.encode())
+    for path in _feed_paths(feed):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def cached_feed_hash(feed, cache_dir=CACHE_DIR):
+    """feed_hash of feed, hashed again only when the size or modification time of its files changed.
+
+    The hashes are kept in hashes.json in cache_dir by the absolute path of the feed.
+    """
+    stat = [[os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in _feed_paths(feed)]
+    hashes_path = os.path.join(cache_dir, 'hashes.json')
+    try:
+        with open(hashes_path) as file:
+            hashes = json.load(file)
+    except (OSError, ValueError):
+        hashes = {}
+    key = os.path.abspath(feed)
+    if key in hashes and hashes[key]['stat'] == stat and hashes[key]['version'] == CACHE_VERSION:
+        return hashes[key]['hash']
+
+    hashes[key] = {'stat': stat, 'version': CACHE_VERSION, 'hash': feed_hash(feed)}
+    # Replaced in one step, so a reader never sees half a file
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(hashes_path + '.tmp', 'w') as file:
+        json.dump(hashes, file)
+    os.replace(hashes_path + '.tmp', hashes_path)
+    return hashes[key]['hash']
+
+
+def _normalize(tables):
+    # Integer stop ids: stops whose id is not a number are stop areas or duplicates of other stops
+    stops = tables['stops']
+    stop_ids = pd.to_numeric(stops['stop_id'].astype(str), errors='coerce')
+    stops = stops[stop_ids.notna().to_numpy()].assign(stop_id=stop_ids.dropna().astype(np.int64).to_numpy())
+    tables['stops'] = stops.drop_duplicates(subset=['stop_id']).reset_index(drop=True)
+
+    # stop_times rows at such stops cannot be linked to a stop and are left out
+    stop_times = tables['stop_times']
+    stop_ids = pd.to_numeric(stop_times['stop_id'].astype(str), errors='coerce')
+    stop_times = stop_times[stop_ids.notna().to_numpy()].assign(stop_id=stop_ids.dropna().astype(np.int64).to_numpy())
+    tables['stop_times'] = stop_times.reset_index(drop=True)
+    return tables
+
+
+def cache_feed(feed, cache_dir=CACHE_DIR):
+    """Return the cache directory of feed, converting the feed first when it is not cached yet."""
+    path = os.path.join(cache_dir, cached_feed_hash(feed, cache_dir))
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return path
+
+    # Written to a temporary directory first, so an interrupted run never leaves half a cache
+    building = path + '.building'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    tables = _normalize(read_feed(feed))
+    for name, frame in tables.items():
+        feather.write_feather(frame, os.path.join(building, f'{name}.arrow'), compression='uncompressed')
+    with open(os.path.join(building, 'meta.json'), 'w') as meta:
+        json.dump({'feed': os.path.abspath(feed), 'version': CACHE_VERSION, 'rows': {name: len(frame) for name, frame in tables.items()}}, meta)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(building, path)
+    return path
+
+
+def _to_pandas(table):
+    # DataFrame of a memory-mapped table, without the categories of the rows that were filtered out
+    frame = table.to_pandas()
+    for column in frame.columns:
+        if isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].cat.remove_unused_categories()
+    return frame
+
+
+def read_cached_feed(feed, date=None, tables=TABLES, columns=None, start_time=None, end_time=None, time_column='departure_time', as_seconds=True, cache_dir=CACHE_DIR):
+    """Read the tables of a GTFS feed from its cache, returns a dict of DataFrames by table name like read_feed.
+
+    With date only the trips of that day and their stop_times are kept,
+    start_time and end_time ('HH:MM:SS' or seconds) keep the stop_times whose
+    time_column lies in that window, ends included. The filters run on the
+    memory-mapped tables, only the rows that pass are copied. With as_seconds
+    the times are int32 seconds, otherwise 'HH:MM:SS' text.
+    """
+    path = cache_feed(feed, cache_dir)
+    columns = columns or {}
+
+    def table(name, names=None):
+        return feather.read_table(os.path.join(path, f'{name}.arrow'), columns=names, memory_map=True)
+
+    frames = {name: _to_pandas(table(name, columns.get(name))) for name in tables if name != 'stop_times'}
+    trip_ids = None
+    if date is not None:
+        trips = frames['trips'] if 'trips' in frames else _to_pandas(table('trips', ['trip_id', 'service_id']))
+        calendar_dates = frames['calendar_dates'] if 'calendar_dates' in frames else _to_pandas(table('calendar_dates'))
+        trips = trips[trips['service_id'].isin(service_ids_on(calendar_dates, date))].reset_index(drop=True)
+        trip_ids = trips['trip_id'].astype(str).unique()
+        if 'trips' in frames:
+            frames['trips'] = trips
+
+    if 'stop_times' in tables:
+        names = columns.get('stop_times')
+        read_names = names if names is None or time_column in names else names + [time_column]
+        stop_times = table('stop_times', read_names)
+        keep = pa.array(np.ones(stop_times.num_rows, dtype=bool))
+        if trip_ids is not None:
+            keep = pc.and_(keep, pc.is_in(stop_times['trip_id'], value_set=pa.array(trip_ids)))
+        start = time_bound(start_time)
+        end = time_bound(end_time)
+        if start is not None:
+            keep = pc.and_(keep, pc.greater_equal(stop_times[time_column], start))
+        if end is not None:
+            keep = pc.and_(keep, pc.less_equal(stop_times[time_column], end))
+        stop_times = _to_pandas(stop_times.filter(keep))
+        if names is not None:
+            stop_times = stop_times[names]
+        if not as_seconds:
+            for column in TIME_COLUMNS:
+                if column in stop_times:
+                    stop_times[column] = format_times(stop_times[column])
+        frames['stop_times'] = stop_times
+    return {name: frames[name] for name in tables}
@@ -0,0 +1,242 @@
+"""Loading GTFS tables with only the columns that are used, compact dtypes and filters applied while reading.
+
+A feed is either a folder with the .txt files or the feed zip itself, which is
+read in place without extracting it. The ids are read as categoricals and times
+as int32 seconds after the start of the service day, so times past 24:00 keep
+working. stop_times.txt is read in chunks and every chunk is filtered before the
+next one is read, so memory follows the rows that are kept instead of the size
+of the file.
+"""
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Tables read by read_feed, stop_times last as it waits for the trips of the day
+TABLES = ['agency', 'calendar_dates', 'routes', 'stops', 'trips', 'stop_times']
+
+# Columns kept by default, and their dtypes while reading
+COLUMNS = {
+    'agency': ['agency_id', 'agency_name'],
+    'calendar_dates': ['service_id', 'date', 'exception_type'],
+    'routes': ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type'],
+    'stops': ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+    'trips': ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'trip_short_name'],
+    'stop_times': ['trip_id', 'stop_sequence', 'stop_id', 'arrival_time', 'departure_time'],
+}
+DTYPES = {
+    'agency_id': 'category',
+    'agency_name': 'category',
+    'service_id': 'category',
+    'date': np.int32,
+    'exception_type': np.int8,
+    'route_id': 'category',
+    'route_short_name': 'category',
+    'route_long_name': 'category',
+    'route_type': np.int16,
+    'stop_id': 'category',
+    'stop_name': str,
+    'stop_lat': np.float64,
+    'stop_lon': np.float64,
+    'trip_id': 'category',
+    'trip_headsign': 'category',
+    'trip_short_name': 'category',
+    'stop_sequence': np.int32,
+    'arrival_time': str,
+    'departure_time': str,
+}
+TIME_COLUMNS = ['arrival_time', 'departure_time']
+
+# Rows of stop_times.txt read at once
+CHUNK_SIZE = 2_000_000
+
+
+def parse_times(times):
+    """Convert GTFS 'H:MM:SS' times, which can run past 24:00, to int32 seconds after the start of the service day (-1 when missing)."""
+    times = pd.Series(times, copy=False)
+    if isinstance(times.dtype, pd.CategoricalDtype):
+        # Every distinct time is parsed once
+        codes = times.cat.codes.to_numpy()
+        return np.where(codes >= 0, parse_times(times.cat.categories.to_numpy())[codes], -1).astype(np.int32)
+    text = np.strings.strip(times.fillna('').to_numpy(dtype=str))
+    if not text.dtype.itemsize:
+        return np.full(len(text), -1, dtype=np.int32)
+
+    # One row of character codes per time, '0' is 0 and ':' is 10, the strings are left aligned
+    width = text.dtype.itemsize // 4
+    chars = text.view(np.uint32).reshape(len(text), width).astype(np.int32) - ord('0')
+    length = np.strings.str_len(text)
+    rows = np.arange(len(text))
+
+    def from_end(position):
+        # The character at position from the end of every time
+        return chars[rows, np.maximum(length - position, 0)]
+
+    digits = [from_end(position) for position in (1, 2, 4, 5)]
+    valid = (length >= 7) & (from_end(3) == 10) & (from_end(6) == 10)
+    for digit in digits:
+        valid &= (digit >= 0) & (digit <= 9)
+    seconds = digits[1] * 10 + digits[0]
+    minutes = digits[3] * 10 + digits[2]
+
+    # The hours are all characters before the minutes, any number of digits
+    hours = np.zeros(len(text), dtype=np.int32)
+    for position in range(width - 6):
+        inside = position < length - 6
+        digit = chars[:, position]
+        valid &= ~inside | ((digit >= 0) & (digit <= 9))
+        hours = np.where(inside, hours * 10 + digit, hours)
+    valid &= (minutes < 60) & (seconds < 60)
+    return np.where(valid, hours * 3600 + minutes * 60 + seconds, -1).astype(np.int32)
+
+
+def format_times(seconds):
+    """Convert seconds after the start of the service day back to 'HH:MM:SS' strings (None when missing)."""
+    seconds = np.asarray(seconds, dtype=np.int64)
+    hours = pd.Series(seconds // 3600).astype(str).str.zfill(2)
+    minutes = pd.Series(seconds % 3600 // 60).astype(str).str.zfill(2)
+    rest = pd.Series(seconds % 60).astype(str).str.zfill(2)
+    return np.where(seconds < 0, None, (hours + ':' + minutes + ':' + rest).to_numpy(dtype=object))
+
+
+def time_bound(time):
+    """Seconds of a time window bound given as seconds or as 'HH:MM:SS', None stays None."""
+    if time is None or not isinstance(time, str):
+        return time
+    return int(parse_times([time])[0])
+
+
+def _dtypes(columns):
+    # Ids as categoricals, times as text that is parsed per chunk
+    return {column: DTYPES[column] for column in columns if column in DTYPES}
+
+
+def _open(feed, name):
+    # The file of a table in a feed folder, or the member of a feed zip, which may sit in a subfolder of the zip
+    if os.path.isdir(feed):
+        return open(os.path.join(feed, f'{name}.txt'), 'rb')
+    with zipfile.ZipFile(feed) as archive:
+        members = [member for member in archive.namelist() if os.path.basename(member) == f'{name}.txt']
+        if not members:
+            raise FileNotFoundError(f'{name}.txt is not in {feed}')
+        # The member stays readable after the archive is closed
+        return archive.open(members[0])
+
+
+def read_table(feed, name, columns=None):
+    """Read one GTFS table (such as 'trips') with only the given columns, by default those in COLUMNS."""
+    columns = columns or COLUMNS[name]
+    with _open(feed, name) as file:
+        return pd.read_csv(file, usecols=columns, dtype=_dtypes(columns))
+
+
+def service_ids_on(calendar_dates, date):
+    """Service ids that run on a date ('YYYY-MM-DD' or 'YYYYMMDD') according to calendar_dates.txt."""
+    date = int(str(date).replace('-', ''))
+    active = calendar_dates[(calendar_dates['date'] == date) & (calendar_dates['exception_type'] == 1)]
+    return active['service_id'].unique()
+
+
+def _trips_on(trips, calendar_dates, date):
+    # The trips that run on date
+    return trips[trips['service_id'].isin(service_ids_on(calendar_dates, date))].reset_index(drop=True)
+
+
+def read_trips(feed, date=None, columns=None):
+    """Read trips.txt, only the trips that run on date when one is given."""
+    trips = read_table(feed, 'trips', columns)
+    if date is not None:
+        trips = _trips_on(trips, read_table(feed, 'calendar_dates'), date)
+    return trips
+
+
+def read_stop_times(feed, trip_ids=None, start_time=None, end_time=None, time_column='departure_time', columns=None, as_seconds=True, chunksize=CHUNK_SIZE):
+    """Read stop_times.txt in chunks, keeping only the rows that pass the filters.
+
+    trip_ids limits the rows to those trips, for example the trips of one
+    service date from read_trips. start_time and end_time ('HH:MM:SS' or
+    seconds) keep the rows whose time_column lies in that window, ends included.
+    With as_seconds the time columns become int32 seconds, otherwise they stay
+    text.
+    """
+    columns = columns or COLUMNS['stop_times']
+    read_columns = columns if time_column in columns else columns + [time_column]
+    start = time_bound(start_time)
+    end = time_bound(end_time)
+    trip_ids = pd.Index(pd.unique(np.asarray(trip_ids).astype(str))) if trip_ids is not None else None
+
+    chunks = []
+    with _open(feed, 'stop_times') as file:
+        for chunk in pd.read_csv(file, usecols=read_columns, dtype=_dtypes(read_columns), chunksize=chunksize):
+            chunks.append(_filter_chunk(chunk, trip_ids, start, end, time_column, columns, as_seconds))
+    return _concat(chunks, columns)
+
+
+def read_feed(feed, date=None, tables=TABLES, columns=None, workers=None, **stop_times_options):
+    """Read the tables of a GTFS feed concurrently, returns a dict of DataFrames by table name.
+
+    Every table is decoded in its own thread; pandas and zlib release the GIL
+    while parsing and inflating, so reading a feed takes about as long as its
+    largest file, stop_times.txt. With date only the trips of that day are kept
+    and stop_times.txt is filtered to those trips while it is read. columns maps
+    table names to the columns to keep, stop_times_options go to read_stop_times.
+    """
+    columns = columns or {}
+    with ThreadPoolExecutor(workers or len(tables)) as pool:
+        futures = {name: pool.submit(read_table, feed, name, columns.get(name)) for name in tables if name != 'stop_times'}
+
+        def day_trips():
+            # The trips of the day, once trips.txt and calendar_dates.txt are read
+            trips = futures['trips'].result()
+            if date is None:
+                return trips
+            calendar_dates = futures['calendar_dates'].result() if 'calendar_dates' in futures else read_table(feed, 'calendar_dates')
+            return _trips_on(trips, calendar_dates, date)
+
+        def stop_times():
+            trip_ids = day_trips()['trip_id'] if date is not None and 'trips' in futures else None
+            return read_stop_times(feed, trip_ids=trip_ids, columns=columns.get('stop_times'), **stop_times_options)
+
+        # stop_times is submitted last, so the tables it waits for are already running even with a single worker
+        if 'stop_times' in tables:
+            futures['stop_times'] = pool.submit(stop_times)
+        frames = {name: futures[name].result() for name in tables}
+        if 'trips' in frames:
+            frames['trips'] = day_trips()
+        return frames
+
+
+def _filter_chunk(chunk, trip_ids, start, end, time_column, columns, as_seconds):
+    # The rows of one chunk of stop_times.txt that pass the filters
+    if trip_ids is not None:
+        chunk = chunk[chunk['trip_id'].isin(trip_ids)]
+    if start is not None or end is not None:
+        times = parse_times(chunk[time_column])
+        keep = np.ones(len(chunk), dtype=bool)
+        if start is not None:
+            keep &= times >= start
+        if end is not None:
+            keep &= times <= end
+        chunk = chunk[keep]
+    chunk = chunk[columns].copy()
+    if as_seconds:
+        for column in TIME_COLUMNS:
+            if column in chunk:
+                chunk[column] = parse_times(chunk[column])
+    return chunk
+
+
+def _concat(chunks, columns):
+    # Join the chunks column by column, categoricals get the union of the categories that are used
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    frame = {}
+    for column in columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            frame[column] = union_categoricals([chunk[column] for chunk in chunks]).remove_unused_categories()
+        else:
+            frame[column] = np.concatenate([chunk[column].to_numpy() for chunk in chunks])
+    return pd.DataFrame(frame)
@@ -1,4 +1,4 @@
-import time
+from concurrent.futures import ThreadPoolExecutor
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
                        QgsFeatureSink,
@@ -9,11 +9,14 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterNumber,
                        QgsWkbTypes,
                        QgsFeature,
-                       QgsVectorLayer,
-                       QgsFields,
+                       QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsSpatialIndex,
                        QgsField)
 from qgis.PyQt.QtCore import QVariant
-from qgis import processing
+
+# Number of network lines whose concave hulls are computed together
+HULL_BATCH_SIZE = 500
 
 class IsochroneGeneratorAlgorithm(QgsProcessingAlgorithm):
     INPUT_NETWORK = 'INPUT_NETWORK'
@@ -116,10 +119,55 @@ class IsochroneGeneratorAlgorithm(QgsProcessingAlgorithm):
         if sink is None:
             raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
 
+        # Load all service access points once and index them, instead of scanning the
+        # full source for every network line
+        sap_index = QgsSpatialIndex()
+        sap_points = {}
+        sap_request = QgsFeatureRequest().setNoAttributes().setDestinationCrs(network_layer.crs(), context.transformContext())
+        for sap_feature in source_saps.getFeatures(sap_request):
+            if sap_feature.hasGeometry():
+                sap_index.addFeature(sap_feature)
+                sap_points[sap_feature.id()] = sap_feature.geometry()
+
+        def intersecting_points(line_geometry):
+            # Points that intersect the line, bounding box candidates from the index are checked exactly
+            engine = QgsGeometry.createGeometryEngine(line_geometry.constGet())
+            engine.prepareGeometry()
+            point_count = 0
+            points = []
+            for sap_id in sap_index.intersects(line_geometry.boundingBox()):
+                point = sap_points[sap_id]
+                if engine.intersects(point.constGet()):
+                    point_count += 1
+                    points.extend(point.asMultiPoint() if point.isMultipart() else [point.asPoint()])
+            return point_count, points
+
+        def concave_hull(points):
+            # Same hull as native:concavehull on the extracted points
+            return QgsGeometry.fromMultiPointXY(points).concaveHull(alpha, False)
+
+        def write_batch(batch):
+            # Compute the concave hulls of a batch of lines on several threads
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                hulls = list(executor.map(concave_hull, [points for _, _, points in batch]))
+            for (original_attributes, point_count, _), hull in zip(batch, hulls):
+                if hull.isEmpty() or hull.type() != QgsWkbTypes.PolygonGeometry:
+                    continue
+
+                # Create a new feature for the output layer
+                out_feat = QgsFeature(fields)
+                out_feat.setGeometry(hull)
+                out_feat.setAttributes(original_attributes + [point_count])
+
+                # Add the feature to the output sink
+                sink.addFeature(out_feat, QgsFeatureSink.FastInsert)
+
         # Calculate the progress step
         total = 100.0 / network_layer.featureCount() if network_layer.featureCount() else 0
+        threads = max(context.maximumThreads(), 1)
 
-        # Iterate over each feature in the network layer
+        # Match the points to each network line, lines with more than two points get a hull
+        batch = []
         for current, network_feature in enumerate(network_layer.getFeatures()):
             if feedback.isCanceled():
                 break
@@ -127,71 +175,16 @@ class IsochroneGeneratorAlgorithm(QgsProcessingAlgorithm):
             # Update the progress
             feedback.setProgress(int(current * total))
 
-            # Get the original attributes of the network feature
-            original_attributes = network_feature.attributes()
-
-            # Create a temporary network layer
-            temp_network = QgsVectorLayer(
-                f"LineString?crs={network_layer.crs().authid()}&field=fid:integer&field=stop_name1:string&field=CLUSTER_ID:integer&field=type:string&field=start:string",
-                "temp",
-                "memory"
-            )
-
-            # Start editing the temporary network layer
-            temp_network.startEditing()
-            temp_feature = QgsFeature()
-            temp_feature.setGeometry(network_feature.geometry())
-            temp_feature.setAttributes(original_attributes)
-            temp_network.addFeature(temp_feature)
-            temp_network.commitChanges()
-
-            # Extract points that intersect with the temporary network layer
-            extracted_result = processing.run(
-                "native:extractbylocation",
-                {
-                    'INPUT': parameters[self.INPUT_SAPS],
-                    'PREDICATE': [0],
-                    'INTERSECT': temp_network,
-                    'OUTPUT': 'memory:'
-                },
-                context=context,
-                feedback=feedback
-            )
-
-            extracted_layer = extracted_result['OUTPUT']
-
-            # Count the number of extracted points
-            point_count = extracted_layer.featureCount()
+            # Count the points that intersect with the network line
+            point_count, points = intersecting_points(network_feature.geometry())
 
             if point_count > 2:
-                # Generate a concave hull from the extracted points
-                hull_result = processing.run(
-                    "native:concavehull",
-                    {
-                        'INPUT': extracted_layer,
-                        'ALPHA': alpha,
-                        'HOLES': False,
-                        'OUTPUT': 'memory:'
-                    },
-                    context=context,
-                    feedback=feedback
-                )
-
-                hull_layer = hull_result['OUTPUT']
-
-                if hull_layer.featureCount() > 0:
-                    hull_feature = next(hull_layer.getFeatures())
-
-                    # Create a new feature for the output layer
-                    out_feat = QgsFeature(fields)
-                    out_feat.setGeometry(hull_feature.geometry())
-                    out_feat.setAttributes(original_attributes + [point_count])
-
-                    # Add the feature to the output sink
-                    sink.addFeature(out_feat, QgsFeatureSink.FastInsert)
-
-            # Introduce a delay
-            time.sleep(0.1)  # Adjust the sleep duration as needed
+                batch.append((network_feature.attributes(), point_count, points))
+                if len(batch) >= HULL_BATCH_SIZE:
+                    write_batch(batch)
+                    batch = []
+
+        write_batch(batch)
 
         # Return the output layer ID
         return {self.OUTPUT: dest_id}
@@ -0,0 +1,128 @@
+import json
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+# Isochrone thresholds of the interactive map, in seconds
+THRESHOLDS = (30 * 60, 60 * 60)
+
+# Concave hull ratio of the isochrone polygons, the same default as the ALPHA of Isochrones.py
+HULL_RATIO = 0.05
+
+# Departure time of the precomputed isochrones, in the 17:00-18:00 window PTAL uses
+DEPARTURE_TIME = 17 * 3600
+
+
+# Timetable of a worker process, set once by the pool initializer
+_worker_timetable = None
+
+
+def _init_worker(timetable):
+    global _worker_timetable
+    _worker_timetable = timetable
+
+
+def _reachable_bands(timetable, sources, departure_time, thresholds):
+    # Indexes of the stops reached in each threshold band, every band sorted
+    arrival = timetable.earliest_arrival(sources, departure_time, max_duration=thresholds[-1])
+    travel_time = arrival - departure_time
+    bands = []
+    lower = -1
+    for threshold in thresholds:
+        bands.append(np.flatnonzero((travel_time > lower) & (travel_time <= threshold)))
+        lower = threshold
+    return bands
+
+
+def _sap_bands(task):
+    sources, departure_time, thresholds = task
+    return _reachable_bands(_worker_timetable, sources, departure_time, thresholds)
+
+
+def precompute_reachability(timetable, path, saps=None, departure_time=DEPARTURE_TIME, thresholds=THRESHOLDS, workers=1):
+    """Store the stops every SAP reaches within each threshold in the directory path.
+
+    saps maps SAP ids to their stop ids, by default every stop is its own SAP.
+    Per SAP the reached stops are stored band by band: first the stops within
+    the first threshold, then those only within the second, each band sorted.
+    The stops within a threshold are therefore a prefix of the SAP's stops, and
+    a 30-minute set costs nothing on top of the 60-minute one. Stop indexes use
+    the smallest unsigned integer type that fits.
+    """
+    if saps is None:
+        saps = {stop_id: [stop_id] for stop_id in timetable.stop_ids.tolist()}
+    thresholds = sorted(thresholds)
+    tasks = [(sources, departure_time, thresholds) for sources in saps.values()]
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(timetable,)) as pool:
+            all_bands = pool.map(_sap_bands, tasks, chunksize=16)
+    else:
+        all_bands = [_reachable_bands(timetable, *task) for task in tasks]
+
+    # CSR layout: the stops of SAP i are stops[indptr[i]:indptr[i + 1]], ends[i, k] is the end of band k
+    stop_dtype = np.min_scalar_type(max(len(timetable.stop_ids) - 1, 0))
+    sizes = np.array([[len(band) for band in bands] for bands in all_bands], dtype=np.int64).reshape(len(all_bands), len(thresholds))
+    indptr = np.r_[0, np.cumsum(sizes.sum(axis=1))].astype(np.int64)
+    ends = (indptr[:-1, None] + np.cumsum(sizes, axis=1)).astype(np.int64)
+    stops = np.concatenate([band for bands in all_bands for band in bands] or [np.empty(0)]).astype(stop_dtype)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'sap_ids.npy'), np.asarray(list(saps), dtype=str))
+    np.save(os.path.join(path, 'stop_lonlat.npy'), timetable.stop_lonlat)
+    np.save(os.path.join(path, 'indptr.npy'), indptr)
+    np.save(os.path.join(path, 'ends.npy'), ends)
+    np.save(os.path.join(path, 'stops.npy'), stops)
+    with open(os.path.join(path, 'meta.json'), 'w') as meta:
+        json.dump({'thresholds': thresholds, 'departure_time': departure_time}, meta)
+
+
+class ReachabilityStore:
+    """Memory-mapped reachability sets from precompute_reachability, with lazily built isochrones.
+
+    A click on a SAP becomes a lookup of its stop range; the isochrone polygon is
+    the concave hull of the reached stops, built on first use and kept in a
+    least-recently-used cache of cache_size polygons.
+    """
+
+    def __init__(self, path, cache_size=256, hull_ratio=HULL_RATIO):
+        with open(os.path.join(path, 'meta.json')) as meta:
+            meta = json.load(meta)
+        self.thresholds = meta['thresholds']
+        self.departure_time = meta['departure_time']
+        self.sap_ids = np.load(os.path.join(path, 'sap_ids.npy'))
+        self.stop_lonlat = np.load(os.path.join(path, 'stop_lonlat.npy'), mmap_mode='r')
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+        self.ends = np.load(os.path.join(path, 'ends.npy'), mmap_mode='r')
+        self.stops = np.load(os.path.join(path, 'stops.npy'), mmap_mode='r')
+        self.sap_index = {sap_id: index for index, sap_id in enumerate(self.sap_ids.tolist())}
+        self.cache_size = cache_size
+        self.hull_ratio = hull_ratio
+        self.hulls = OrderedDict()
+
+    def reachable(self, sap_id, threshold):
+        """Return the indexes of the stops a SAP reaches within threshold seconds, one of the stored thresholds."""
+        index = self.sap_index[sap_id]
+        band = self.thresholds.index(threshold)
+        return np.asarray(self.stops[self.indptr[index]:self.ends[index, band]])
+
+    def isochrone(self, sap_id, threshold):
+        """Return the isochrone polygon in longitude and latitude, or None when fewer than three stops are reached."""
+        key = (sap_id, threshold)
+        if key in self.hulls:
+            self.hulls.move_to_end(key)
+            return self.hulls[key]
+
+        coords = self.stop_lonlat[self.reachable(sap_id, threshold)]
+        hull = None
+        if len(coords) > 2:
+            hull = shapely.concave_hull(shapely.multipoints(coords), ratio=self.hull_ratio)
+            if not isinstance(hull, shapely.Polygon):
+                hull = None
+
+        self.hulls[key] = hull
+        if len(self.hulls) > self.cache_size:
+            self.hulls.popitem(last=False)
+        return hull
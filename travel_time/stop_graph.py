@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+def _codes(values):
+    # Integer codes of ids, categoricals keep the codes they already have
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy().astype(np.int32), values.cat.categories.to_numpy()
+    codes, uniques = pd.factorize(values)
+    return codes.astype(np.int32), np.asarray(uniques)
+
+
+def fastest_edges(stop_times):
+    """Return the fastest ride from every stop to every next stop of a trip, one row per pair of stops.
+
+    stop_times has trip_id, stop_sequence, stop_id, arrival_time and
+    departure_time, with the times in seconds; trips with a missing time (-1)
+    are left out. The rows have stop_id, stop_id2, duration_to_next_stop (the
+    arrival at stop_id2 minus the departure at stop_id, in seconds) and the
+    trip_id and stop_sequence of the fastest ride. Stops are handled as integer
+    codes, the ids are only looked up for the result.
+    """
+    trip, trip_ids = _codes(stop_times['trip_id'])
+    stop, stop_ids = _codes(stop_times['stop_id'])
+    sequence = stop_times['stop_sequence'].to_numpy()
+    arrival = stop_times['arrival_time'].to_numpy()
+    departure = stop_times['departure_time'].to_numpy()
+
+    # Trips with a missing time
+    missing = np.zeros(len(trip_ids), dtype=bool)
+    missing[trip[((arrival < 0) | (departure < 0)) & (trip >= 0)]] = True
+
+    # Every stop of a trip followed by its next stop
+    order = np.lexsort((sequence, trip))
+    trip = trip[order]
+    known = (trip >= 0) & (stop[order] >= 0)
+    ride = np.flatnonzero((trip[1:] == trip[:-1]) & ~missing[trip[:-1]] & known[:-1] & known[1:])
+    origin = order[ride]
+    destination = order[ride + 1]
+    duration = arrival[destination] - departure[origin]
+
+    # The fastest ride of every pair of stops: sorted by pair and duration, the first ride of every pair
+    pair = stop[origin].astype(np.int64) * len(stop_ids) + stop[destination]
+    by_pair = np.lexsort((duration, pair))
+    first = by_pair[np.r_[True, pair[by_pair][1:] != pair[by_pair][:-1]]] if len(by_pair) else by_pair
+    return pd.DataFrame({
+        'stop_id': stop_ids[stop[origin[first]]],
+        'stop_id2': stop_ids[stop[destination[first]]],
+        'duration_to_next_stop': duration[first].astype(np.int32),
+        'trip_id': trip_ids[trip[ride[first]]],
+        'stop_sequence': sequence[origin[first]],
+    })
+
+
+class StopGraph:
+    """The fastest rides between consecutive stops as a compact CSR graph.
+
+    The rides leaving the stop with index i are neighbors[indptr[i]:indptr[i + 1]]
+    with their durations in seconds; stop_ids gives the id of every index.
+    """
+
+    ARRAYS = ['stop_ids', 'indptr', 'neighbors', 'durations']
+
+    def __init__(self, stop_ids, indptr, neighbors, durations):
+        self.stop_ids = np.asarray(stop_ids)
+        if self.stop_ids.dtype == object:
+            self.stop_ids = self.stop_ids.astype(str)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.neighbors = np.asarray(neighbors, dtype=np.int32)
+        self.durations = np.asarray(durations, dtype=np.int32)
+        self.stop_index = {stop_id: index for index, stop_id in enumerate(self.stop_ids.tolist())}
+
+    @classmethod
+    def from_edges(cls, edges, stop_ids=None):
+        """Build the graph from the rows of fastest_edges, stop_ids can add stops without rides."""
+        ids = [edges['stop_id'].to_numpy(), edges['stop_id2'].to_numpy()]
+        if stop_ids is not None:
+            ids.append(np.asarray(stop_ids))
+        codes, uniques = pd.factorize(np.concatenate(ids))
+        origin = codes[:len(edges)]
+        destination = codes[len(edges):2 * len(edges)]
+        order = np.lexsort((destination, origin))
+        indptr = np.searchsorted(origin[order], np.arange(len(uniques) + 1))
+        return cls(uniques, indptr, destination[order], edges['duration_to_next_stop'].to_numpy()[order])
+
+    def save(self, path):
+        """Store the arrays in an .npz file, load it back with StopGraph.load."""
+        np.savez(path, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+    def matrix(self):
+        """The graph as a SciPy sparse matrix of durations, for scipy.sparse.csgraph."""
+        # Rides of 0 seconds stay stored as explicit zeros, csgraph keeps them as edges; negative
+        # durations from arrival times before the departure count as 0
+        return csr_matrix((np.maximum(self.durations, 0), self.neighbors, self.indptr), shape=(len(self.stop_ids), len(self.stop_ids)))
+
+    def travel_times(self, sources, max_duration=3600):
+        """Return (stop ids, travel times in seconds) of all stops reached within max_duration over the fastest rides.
+
+        Waiting and transfers are not included, timetable.py has the router that
+        follows the actual departures.
+        """
+        source_index = [self.stop_index[stop_id] for stop_id in sources if stop_id in self.stop_index]
+        if not source_index:
+            return self.stop_ids[:0], np.empty(0, dtype=np.int32)
+        times = dijkstra(self.matrix(), indices=source_index, min_only=True, limit=max_duration)
+        reached = np.flatnonzero(np.isfinite(times))
+        return self.stop_ids[reached], times[reached].astype(np.int32)
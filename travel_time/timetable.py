@@ -0,0 +1,206 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# The GTFS loader is shared with the PTAL notebook
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gtfs_tools'))
+from gtfs_cache import read_cached_feed
+from gtfs_loader import parse_times, read_feed
+
+# Walking between nearby stops to transfer, at the same walking speed as PTAL (80 m/min)
+WALKING_SPEED = 80 / 60  # meters per second
+MAX_TRANSFER_DISTANCE = 250  # meters
+
+# Minimum time to change from one vehicle to another at the same stop
+MIN_TRANSFER_TIME = 120  # seconds
+
+# Rounds of the search, the number of vehicles a journey can use
+MAX_ROUNDS = 8
+
+
+class Timetable:
+    """Connections of one service day as compact arrays, for earliest-arrival queries.
+
+    A connection is a vehicle riding from one stop to the next stop of its trip.
+    Connections are stored grouped by trip, in stop order, with departure and
+    arrival times in seconds after midnight. Stops are numbered by their index
+    in stop_ids, with their coordinates in meters (stop_coords) and longitude and
+    latitude (stop_lonlat). Footpaths connect stops within MAX_TRANSFER_DISTANCE.
+    """
+
+    ARRAYS = ['stop_ids', 'stop_coords', 'stop_lonlat', 'dep_stop', 'arr_stop', 'dep_time', 'arr_time', 'trip', 'footpath_from', 'footpath_to', 'footpath_time']
+
+    def __init__(self, stop_ids, stop_coords, stop_lonlat, dep_stop, arr_stop, dep_time, arr_time, trip, footpath_from=None, footpath_to=None, footpath_time=None):
+        self.stop_ids = np.asarray(stop_ids).astype(str)
+        self.stop_coords = np.asarray(stop_coords, dtype=np.float64).reshape(-1, 2)
+        self.stop_lonlat = np.asarray(stop_lonlat, dtype=np.float64).reshape(-1, 2)
+        self.dep_stop = np.asarray(dep_stop, dtype=np.int32)
+        self.arr_stop = np.asarray(arr_stop, dtype=np.int32)
+        self.dep_time = np.asarray(dep_time, dtype=np.int32)
+        self.arr_time = np.asarray(arr_time, dtype=np.int32)
+        self.trip = np.asarray(trip, dtype=np.int32)
+        if footpath_from is None:
+            footpath_from, footpath_to, footpath_time = self._footpaths(self.stop_coords)
+        # Footpaths sorted by the stop they leave from, footpath_indptr gives the range of every stop
+        order = np.argsort(np.asarray(footpath_from), kind='stable')
+        self.footpath_from = np.asarray(footpath_from, dtype=np.int32)[order]
+        self.footpath_to = np.asarray(footpath_to, dtype=np.int32)[order]
+        self.footpath_time = np.asarray(footpath_time, dtype=np.int32)[order]
+        self.footpath_indptr = np.searchsorted(self.footpath_from, np.arange(len(self.stop_ids) + 1)).astype(np.int64)
+        self.stop_index = {stop_id: index for index, stop_id in enumerate(self.stop_ids.tolist())}
+
+        # Connections sorted by departure time, so a query only looks at its own time window
+        self.by_departure = np.argsort(self.dep_time, kind='stable').astype(np.int32)
+        self.sorted_dep_time = self.dep_time[self.by_departure]
+
+    @staticmethod
+    def _footpaths(stop_coords):
+        # Walking transfers in both directions between all stops within MAX_TRANSFER_DISTANCE
+        if len(stop_coords) < 2:
+            empty = np.empty(0, dtype=np.int32)
+            return empty, empty, empty
+        pairs = cKDTree(stop_coords).query_pairs(MAX_TRANSFER_DISTANCE, output_type='ndarray')
+        lengths = np.hypot(*(stop_coords[pairs[:, 0]] - stop_coords[pairs[:, 1]]).T)
+        times = np.ceil(lengths / WALKING_SPEED).astype(np.int32)
+        return np.r_[pairs[:, 0], pairs[:, 1]], np.r_[pairs[:, 1], pairs[:, 0]], np.r_[times, times]
+
+    @classmethod
+    def from_gtfs(cls, feed, date, cache_dir=None):
+        """Build the timetable of one date from the stops, trips, stop_times and calendar_dates of a GTFS folder or zip.
+
+        With cache_dir the tables are read from the columnar cache of the feed in
+        that directory, which is built on first use.
+        """
+        options = dict(
+            tables=['calendar_dates', 'stops', 'trips', 'stop_times'],
+            columns={'stops': ['stop_id', 'stop_lat', 'stop_lon'], 'trips': ['trip_id', 'service_id']},
+        )
+        if cache_dir is None:
+            tables = read_feed(feed, date, **options)
+        else:
+            tables = read_cached_feed(feed, date, cache_dir=cache_dir, **options)
+        # Plain string ids, the categories of the tables differ
+        stops = tables['stops'].astype({'stop_id': str})
+        trips = tables['trips'].astype({'trip_id': str})
+        stop_times = tables['stop_times'].astype({'trip_id': str, 'stop_id': str})
+        return cls.from_frames(stops, trips, stop_times)
+
+    @classmethod
+    def from_frames(cls, stops, trips, stop_times):
+        """Build the timetable from stops, the trips of one day and their stop_times as DataFrames.
+
+        Times are 'HH:MM:SS' text or seconds after midnight.
+        """
+        stop_times = stop_times[stop_times['trip_id'].isin(trips['trip_id'])].sort_values(['trip_id', 'stop_sequence'])
+        stops = stops.drop_duplicates('stop_id').reset_index(drop=True)
+        stop_index = pd.Series(np.arange(len(stops), dtype=np.int32), index=stops['stop_id'])
+
+        trip_codes, _ = pd.factorize(stop_times['trip_id'])
+        stop = stop_index.reindex(stop_times['stop_id']).to_numpy()
+        arrival = _seconds(stop_times['arrival_time'])
+        departure = _seconds(stop_times['departure_time'])
+
+        # A connection runs from every stop of a trip to its next stop
+        same_trip = trip_codes[:-1] == trip_codes[1:]
+        keep = same_trip & ~np.isnan(stop[:-1]) & ~np.isnan(stop[1:]) & (departure[:-1] >= 0) & (arrival[1:] >= 0)
+        first = np.flatnonzero(keep)
+        return cls(
+            stops['stop_id'].to_numpy(),
+            _project(stops['stop_lat'].to_numpy(), stops['stop_lon'].to_numpy()),
+            stops[['stop_lon', 'stop_lat']].to_numpy(),
+            stop[first].astype(np.int32),
+            stop[first + 1].astype(np.int32),
+            departure[first],
+            np.maximum(arrival[first + 1], departure[first]),
+            trip_codes[first],
+        )
+
+    def save(self, path):
+        """Store the arrays in an .npz file, load it back with Timetable.load."""
+        np.savez(path, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+    def earliest_arrival(self, sources, departure_time, max_duration=3600, max_rounds=MAX_ROUNDS):
+        """Return the earliest arrival time at every stop when leaving the source stops at departure_time.
+
+        sources are stop ids, such as all stops of one SAP. Times are seconds after
+        midnight, np.inf for stops that cannot be reached within max_duration.
+        Waiting at the first stop, waiting for connecting vehicles, the minimum
+        transfer time between vehicles and walking transfers are included.
+        """
+        end_time = departure_time + max_duration
+        arrival = np.full(len(self.stop_ids), np.inf)
+        source_index = [self.stop_index[stop_id] for stop_id in sources if stop_id in self.stop_index]
+        arrival[source_index] = departure_time
+        self._walk(arrival, np.asarray(source_index, dtype=np.int32))
+
+        # Connections in the time window, grouped by trip in stop order
+        lo, hi = np.searchsorted(self.sorted_dep_time, [departure_time, end_time], side='left')
+        window = np.sort(self.by_departure[lo:hi])
+        dep_stop = self.dep_stop[window]
+        arr_stop = self.arr_stop[window]
+        dep_time = self.dep_time[window]
+        arr_time = self.arr_time[window]
+        trip_start = np.r_[True, self.trip[window][1:] != self.trip[window][:-1]]
+        trip_first = np.maximum.accumulate(np.where(trip_start, np.arange(len(window)), 0))
+
+        # Boarding at a stop reached by vehicle needs the minimum transfer time, at the
+        # source stops and stops reached on foot the vehicle can be boarded right away
+        ready = arrival.copy()
+
+        for _ in range(max_rounds):
+            # A trip can be boarded at its first stop that is reached in time, and is
+            # ridden from there on; each round allows one more vehicle
+            boardable = dep_time >= ready[dep_stop]
+            boarded_count = np.cumsum(boardable)
+            boarded = (boarded_count - np.r_[0, boarded_count][trip_first]) > 0
+            new_arrival = arrival.copy()
+            np.minimum.at(new_arrival, arr_stop[boarded], arr_time[boarded])
+            improved = np.flatnonzero(new_arrival < arrival)
+            if not len(improved):
+                break
+            arrival = new_arrival
+            ready[improved] = arrival[improved] + MIN_TRANSFER_TIME
+            walked = self._walk(arrival, improved)
+            ready[walked] = np.minimum(ready[walked], arrival[walked])
+
+        arrival[arrival > end_time] = np.inf
+        return arrival
+
+    def _walk(self, arrival, stops):
+        # Relax the footpaths leaving the given stops, returns the stops that improved
+        starts = self.footpath_indptr[stops]
+        counts = self.footpath_indptr[np.asarray(stops) + 1] - starts
+        if not counts.sum():
+            return np.empty(0, dtype=np.int32)
+        leaving = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        to = self.footpath_to[leaving]
+        before = arrival[to]
+        np.minimum.at(arrival, to, arrival[self.footpath_from[leaving]] + self.footpath_time[leaving])
+        return np.unique(to[arrival[to] < before])
+
+    def travel_times(self, sources, departure_time, max_duration=3600):
+        """Return (stop ids, travel times in seconds) of all stops reached within max_duration."""
+        arrival = self.earliest_arrival(sources, departure_time, max_duration)
+        reached = np.flatnonzero(np.isfinite(arrival))
+        return self.stop_ids[reached], (arrival[reached] - departure_time).astype(np.int32)
+
+
+def _project(lat, lon):
+    # Local equirectangular projection to meters, accurate enough for transfer distances
+    lat0 = np.radians(np.nanmean(lat)) if len(lat) else 0.0
+    return np.column_stack([np.radians(lon) * 6371000 * np.cos(lat0), np.radians(lat) * 6371000])
+
+
+def _seconds(times):
+    # Times in seconds after midnight, parsed when they are still 'HH:MM:SS' text
+    if pd.api.types.is_integer_dtype(times):
+        return times.to_numpy(dtype=np.int32)
+    return parse_times(times)